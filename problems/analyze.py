@@ -1,7 +1,23 @@
 import os
+import sys
+import threading
+from bisect import bisect_left
 from contextlib import suppress
-from collections import defaultdict
+from functools import partial
+from operator import attrgetter
+from collections import defaultdict, namedtuple
 from pwd import getpwnam
+from time import monotonic as time
+
+
+ProcessEntry = namedtuple('ProcessEntry', ['pid', 'name', 'state', 'ppid', 'uid', 'gid'])
+TreeDiff = namedtuple('TreeDiff', ['added', 'removed', 'changed'])
+
+# The fields scan_processes needs all come before the first kilobyte of a
+# status file, the buffer only grows for oddly long names.
+_STATUS_BUFFER_SIZE = 1024
+_SCAN_CHUNK_SIZE = 256
+_buffers = threading.local()
 
 
 def extract_value(line):
@@ -22,20 +38,89 @@ def get_name_uid(filepath):
     return exctact_properties(filepath, [0, 8])
 
 
-def get_entries():
-    folder = '/proc'
-    process_ids = [id for id in os.listdir(folder) if id.isnumeric()]
-    entries = {}
-    for process_id in process_ids:
-        with suppress(IOError):
-            process_path = os.path.join(folder, process_id)
-            if os.path.exists(process_path):
-                status_path = os.path.join(process_path, 'status')
-                state, ppid = get_ppid_state(status_path)
-                entries[process_id] = (ppid, state)
+def _field(buffer, size, key):
+    start = buffer.find(key, 0, size)
+    if start == -1:
+        return None
+    start += len(key)
+    end = buffer.find(b'\n', start, size)
+    return bytes(buffer[start:size if end == -1 else end])
+
+
+def _read_status(status_path):
+    """Read a status file with a single read into this thread's buffer, None if the process is gone."""
+    buffer = getattr(_buffers, 'status', None)
+    if buffer is None:
+        buffer = _buffers.status = bytearray(_STATUS_BUFFER_SIZE)
+    try:
+        fd = os.open(status_path, os.O_RDONLY)
+    except OSError:
+        return None, 0
+    try:
+        while True:
+            size = os.preadv(fd, [buffer], 0)
+            if size < len(buffer) or buffer.find(b'\nGid:', 0, size) != -1:
+                return buffer, size
+            buffer = _buffers.status = bytearray(2 * len(buffer))
+    except OSError:
+        return None, 0
+    finally:
+        os.close(fd)
+
+
+def _parse_status(pid, buffer, size):
+    """Pick the fields out of a status file by their keys, not by line numbers."""
+    name = _field(buffer, size, b'Name:\t')
+    state = _field(buffer, size, b'\nState:\t')
+    ppid = _field(buffer, size, b'\nPPid:\t')
+    uid = _field(buffer, size, b'\nUid:\t')
+    gid = _field(buffer, size, b'\nGid:\t')
+    if None in (name, state, ppid, uid, gid):
+        return None
+    return ProcessEntry(pid, sys.intern(name.decode(errors='replace')), state[:1].decode(), int(ppid),
+                        int(uid.split(b'\t', 1)[0]), int(gid.split(b'\t', 1)[0]))
+
+
+def _scan_pids(folder, pids):
+    entries = []
+    for pid in pids:
+        buffer, size = _read_status(f'{folder}/{pid}/status')
+        if buffer is not None:
+            entry = _parse_status(pid, buffer, size)
+            if entry is not None:
+                entries.append(entry)
     return entries
 
 
+def _list_pids(folder):
+    with os.scandir(folder) as iterator:
+        return [int(entry.name) for entry in iterator if entry.name.isdigit()]
+
+
+def _scan(folder, pids, executor, scan_pids=_scan_pids):
+    """Run scan_pids over pids, in chunks on executor if there is one, and concatenate the results."""
+    if executor is None:
+        return scan_pids(folder, pids)
+    pids = list(pids)
+    chunks = [pids[index:index + _SCAN_CHUNK_SIZE] for index in range(0, len(pids), _SCAN_CHUNK_SIZE)]
+    return [entry for chunk in executor.map(scan_pids, [folder] * len(chunks), chunks) for entry in chunk]
+
+
+def scan_processes(folder='/proc', executor=None):
+    """Return {pid: ProcessEntry} for every process in folder.
+
+    Every status file is read once into a reused per-thread buffer. Processes
+    that exit during the scan are skipped. With an executor (for example a
+    thread_pool.ThreadPoolExecutor) the pids are read in chunks in parallel.
+    """
+    return {entry.pid: entry for entry in _scan(folder, _list_pids(folder), executor)}
+
+
+def get_entries(folder='/proc', executor=None):
+    return {str(entry.pid): (str(entry.ppid), entry.name)
+            for entry in scan_processes(folder, executor).values()}
+
+
 def get_buckets(entries):
     buckets = defaultdict(set)
     for process_id, value in entries.items():
@@ -56,42 +141,234 @@ def construct_tree(entries, buckets):
     return tree
 
 
-def processes_tree():
-    entries = get_entries()
+def processes_tree(folder='/proc', executor=None):
+    entries = get_entries(folder, executor)
     buckets = get_buckets(entries)
     return construct_tree(entries, buckets)
 
 
-def find_processes_with_file(filename):
-    folder = '/proc'
-    filepath = os.path.abspath(filename)
-    process_ids = [id for id in os.listdir(folder) if id.isnumeric()]
-    processes = []
-    for process_id in process_ids:
-        fd_path = os.path.join(folder, process_id, 'fd')
-        descriptors = os.listdir(fd_path)
-        for descriptor in descriptors:
-            path_to_descriptor = os.path.join(fd_path, descriptor)
-            if os.path.exists(path_to_descriptor):
-                link = os.readlink(path_to_descriptor)
-                if link == filepath:
-                    processes.append(process_id)
-    return processes
-
-
-def find_processes_with_user(username):
-    uid = getpwnam(username).pw_uid
-    folder = '/proc'
-    processes = []
-    process_ids = [id for id in os.listdir(folder) if id.isnumeric()]
-    for process_id in process_ids:
-        status_path = os.path.join(folder, process_id, 'status')
-        if os.path.exists(status_path):
-            name, cur_uid = get_name_uid(status_path)
-            if int(cur_uid) == uid:
-                processes.append((process_id, name))
-    return processes
+class ProcessTreeTracker:
+    """Keeps the tree built by processes_tree up to date with one refresh per poll.
+
+    A refresh lists the pids, which is one directory read, and reads status
+    files only for new processes and for the children of exited ones, which
+    were reparented. Nodes of untouched processes are reused as they are, so
+    a poll costs in proportion to the churn, not to the number of processes.
+    Every full_rescan_every refreshes all status files are read again to
+    catch exec'd commands and reused pids, 0 turns that off. A process
+    whose parent is unknown, because it was not seen yet, hangs off the root.
+    """
+
+    def __init__(self, folder='/proc', executor=None, full_rescan_every=10):
+        self._folder = folder
+        self._executor = executor
+        self._full_rescan_every = full_rescan_every
+        self._refreshes = 0
+        self.entries = {}
+        self.tree = {'0': {'command': None, 'childrens': {}}}
+        self._root = self.tree['0']
+        self._nodes = {0: self._root}
+
+    def _attach(self, entry):
+        parent = self._nodes.get(entry.ppid, self._root)
+        parent['childrens'][str(entry.pid)] = self._nodes[entry.pid]
+
+    def _detach(self, entry):
+        key = str(entry.pid)
+        parent = self._nodes.get(entry.ppid)
+        if parent is None or parent['childrens'].pop(key, None) is None:
+            self._root['childrens'].pop(key, None)
+
+    def refresh(self):
+        """Bring tree and entries up to date, returns a TreeDiff of what happened since the last refresh.
+
+        added and removed are lists of ProcessEntry, changed holds (old, new)
+        pairs of processes whose command or parent changed.
+        """
+        pids = set(_list_pids(self._folder))
+        known = self.entries.keys()
+        exited = known - pids
+        reread = pids - known
+        if self._full_rescan_every and self._refreshes % self._full_rescan_every == 0:
+            reread = pids
+        else:
+            for pid in exited:
+                reread.update(int(child) for child in self._nodes[pid]['childrens'])
+        self._refreshes += 1
+        fresh = {entry.pid: entry for entry in _scan(self._folder, reread & pids, self._executor)}
+        # Processes that exited while their status was read count as gone.
+        exited |= {pid for pid in reread if pid in known and pid not in fresh}
 
+        removed = []
+        for pid in exited:
+            entry = self.entries.pop(pid)
+            self._detach(entry)
+            del self._nodes[pid]
+            removed.append(entry)
+        added = []
+        changed = []
+        for pid, entry in fresh.items():
+            old = self.entries.get(pid)
+            if old is None:
+                self._nodes[pid] = {'command': entry.name, 'childrens': {}}
+                added.append(entry)
+            elif (old.name, old.ppid) != (entry.name, entry.ppid):
+                self._detach(old)
+                self._nodes[pid]['command'] = entry.name
+                changed.append((old, entry))
+            self.entries[pid] = entry
+        for entry in added:
+            self._attach(entry)
+        for _, entry in changed:
+            self._attach(entry)
+        return TreeDiff(added, removed, changed)
+
+
+def _scan_descriptors(folder, pids, inodes):
+    """Return (pid, fd, target, (st_dev, st_ino)) for every open descriptor of pids.
+
+    A pid whose descriptors may not be listed yields (pid, None, None, None).
+    """
+    descriptors = []
+    for pid in pids:
+        try:
+            iterator = os.scandir(f'{folder}/{pid}/fd')
+        except PermissionError:
+            descriptors.append((pid, None, None, None))
+            continue
+        except OSError:
+            continue
+        with iterator:
+            for entry in iterator:
+                try:
+                    target = os.readlink(entry.path)
+                    key = None
+                    if inodes:
+                        info = entry.stat()
+                        key = (info.st_dev, info.st_ino)
+                except OSError:
+                    # Closed meanwhile, or the target is not reachable for us.
+                    continue
+                descriptors.append((pid, int(entry.name), target, key))
+    return descriptors
+
+
+class OpenFileIndex:
+    """Inverted index from open files to the processes holding them, built in one pass over /proc.
+
+    Files are looked up by path and, with inodes enabled, by device and
+    inode, which also finds them through other hard links or bind mounts.
+    under(directory) answers what lsof +D does without rescanning. Processes
+    whose descriptors we may not read are listed in denied instead of
+    failing the scan.
+    """
+
+    def __init__(self, folder='/proc', executor=None, inodes=True):
+        self.denied = []
+        self._by_path = defaultdict(list)
+        self._by_inode = defaultdict(list)
+        self._paths = None
+        scan_pids = partial(_scan_descriptors, inodes=inodes)
+        for pid, fd, target, key in _scan(folder, _list_pids(folder), executor, scan_pids):
+            if fd is None:
+                self.denied.append(pid)
+                continue
+            self._by_path[target].append((pid, fd))
+            if key is not None:
+                self._by_inode[key].append((pid, fd))
+
+    def descriptors(self, filename):
+        """Return sorted (pid, fd) pairs that have filename open."""
+        found = set(self._by_path.get(os.path.abspath(filename), ()))
+        if self._by_inode:
+            with suppress(OSError):
+                info = os.stat(filename)
+                found.update(self._by_inode.get((info.st_dev, info.st_ino), ()))
+        return sorted(found)
+
+    def processes(self, filename):
+        """Return the sorted pids that have filename open."""
+        return sorted({pid for pid, _ in self.descriptors(filename)})
+
+    def lookup(self, filenames):
+        """Return {filename: sorted pids} for many files at once."""
+        return {filename: self.processes(filename) for filename in filenames}
+
+    def under(self, directory):
+        """Return sorted (path, pid, fd) for every open file at or below directory."""
+        if self._paths is None:
+            self._paths = sorted(path for path in self._by_path if path.startswith('/'))
+        directory = os.path.abspath(directory)
+        prefix = directory.rstrip('/') + '/'
+        found = [(directory, pid, fd) for pid, fd in self._by_path.get(directory, ())]
+        for index in range(bisect_left(self._paths, prefix), len(self._paths)):
+            path = self._paths[index]
+            if not path.startswith(prefix):
+                break
+            found.extend((path, pid, fd) for pid, fd in self._by_path[path])
+        return sorted(found)
+
+
+def find_processes_with_file(filename, folder='/proc'):
+    return [str(pid) for pid in OpenFileIndex(folder, inodes=False).processes(filename)]
+
+
+class ProcessIndex:
+    """Processes of one scan indexed by uid, gid, state, ppid and command name.
+
+    query(uid=[1000, 1001], state='D') looks up the most selective
+    criterion in its index and checks the others on those entries only.
+    Indexes hold plain lists of pids and command names are interned, which
+    keeps 100k tasks at a few megabytes on top of the entries. With max_age
+    a query rescans first once the data is older than max_age seconds,
+    otherwise refresh is up to the caller.
+    """
+
+    ATTRIBUTES = ('uid', 'gid', 'state', 'ppid', 'name')
+
+    def __init__(self, folder='/proc', executor=None, max_age=None):
+        self._folder = folder
+        self._executor = executor
+        self._max_age = max_age
+        self.refresh()
+
+    def refresh(self):
+        self.entries = scan_processes(self._folder, self._executor)
+        self._indexes = {attribute: defaultdict(list) for attribute in self.ATTRIBUTES}
+        for entry in self.entries.values():
+            for attribute in self.ATTRIBUTES:
+                self._indexes[attribute][getattr(entry, attribute)].append(entry.pid)
+        self._refreshed = time()
+
+    def query(self, **criteria):
+        """Return the ProcessEntry objects matching all criteria, sorted by pid.
+
+        Every criterion is an attribute name with either one value or a
+        list, tuple or set of accepted values.
+        """
+        if self._max_age is not None and time() - self._refreshed > self._max_age:
+            self.refresh()
+        accepted = {}
+        for attribute, value in criteria.items():
+            if attribute not in self.ATTRIBUTES:
+                raise ValueError(f'unknown attribute {attribute!r}, expected one of {self.ATTRIBUTES}')
+            accepted[attribute] = set(value) if isinstance(value, (list, tuple, set, frozenset)) else {value}
+        if not accepted:
+            return sorted(self.entries.values())
+        selective = min(accepted, key=lambda attribute: sum(len(self._indexes[attribute].get(value, ()))
+                                                            for value in accepted[attribute]))
+        entries = self.entries
+        matches = [entries[pid] for value in accepted.pop(selective)
+                   for pid in self._indexes[selective].get(value, ())]
+        for attribute, values in accepted.items():
+            get = attrgetter(attribute)
+            matches = [entry for entry in matches if get(entry) in values]
+        return sorted(matches)
+
+
+def find_processes_with_user(username, folder='/proc'):
+    uid = getpwnam(username).pw_uid
+    return [(str(entry.pid), entry.name) for entry in ProcessIndex(folder).query(uid=uid)]
 
 
 if __name__ == '__main__':
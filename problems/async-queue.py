@@ -1,6 +1,9 @@
 import threading
 import queue
 from collections import deque
+from contextlib import suppress
+from heapq import heappush, heappop
+from itertools import count
 from time import monotonic as time
 
 try:
@@ -19,7 +22,7 @@ class Queue:
     def __init__(self, maxsize=0):
         self.maxsize = maxsize
         self.queue = deque()
-        self.mutex = threading.RLock()
+        self.mutex = threading.Lock()
 
         # Notify whenever an item is added to the queue; a
         # thread waiting to get is notified then.
@@ -34,6 +37,11 @@ class Queue:
         self.all_tasks_done = threading.Condition(self.mutex)
         self.unfinished_tasks = 0
 
+        # (event loop, asyncio future) pairs of coroutines waiting in
+        # async_get / async_put, woken together with the threads above.
+        self.async_getters = deque()
+        self.async_putters = deque()
+
     def _qsize(self):
         return len(self.queue)
     
@@ -43,6 +51,115 @@ class Queue:
     def _get(self):
         return self.queue.popleft()
 
+    def _ready(self):
+        """Return True if _get can hand out an item right now."""
+        return self._qsize() > 0
+
+    def _ready_in(self):
+        """Return seconds until _ready may turn true without a put, None if only a put can do it."""
+        return None
+
+    def _free_slots(self):
+        if self.maxsize <= 0:
+            return float('inf')
+        return self.maxsize - self._qsize()
+
+    @staticmethod
+    def _wait(condition, predicate, block, timeout, error, ready_in=None):
+        """Wait on condition, held by the caller, until predicate() is true.
+
+        Each waiter is woken for a specific item or slot (notify, never
+        notify_all), so producers and consumers do not stampede. ready_in
+        tells how long predicate() may stay false without a notification.
+        """
+        if predicate():
+            return
+        if not block:
+            raise error
+        if timeout is not None and timeout < 0:
+            raise ValueError('timeout must be greater than 0')
+        endtime = None if timeout is None else time() + timeout
+        while not predicate():
+            remaining = None if endtime is None else endtime - time()
+            if remaining is not None and remaining <= 0.0:
+                raise error
+            if ready_in is not None and (delay := ready_in()) is not None:
+                remaining = delay if remaining is None else min(remaining, delay)
+            condition.wait(remaining)
+
+    @staticmethod
+    def _notify(condition, async_waiters, count=1):
+        """Wake count threads and count coroutines waiting for the same event, mutex held."""
+        condition.notify(count)
+        while count and async_waiters:
+            loop, waiter = async_waiters.popleft()
+            # A waiter woken by its DelayQueue timer is done already and
+            # would swallow the wakeup.
+            if waiter.done():
+                continue
+            with suppress(RuntimeError):
+                loop.call_soon_threadsafe(_wake_waiter, waiter)
+                count -= 1
+
+    def _item_added(self, count=1):
+        self._notify(self.item_added, self.async_getters, count)
+
+    def _item_removed(self, count=1):
+        self._notify(self.item_removed, self.async_putters, count)
+
+    async def _async_wait(self, predicate, async_waiters, ready_in=None):
+        """Coroutine counterpart of _wait, returns with the mutex held."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while True:
+            self.mutex.acquire()
+            if predicate():
+                return
+            waiter = loop.create_future()
+            async_waiters.append((loop, waiter))
+            delay = ready_in() if ready_in is not None else None
+            self.mutex.release()
+            timer = None if delay is None else loop.call_later(delay, _wake_waiter, waiter)
+            try:
+                await waiter
+                if timer is not None:
+                    with self.mutex:
+                        if (loop, waiter) in async_waiters:
+                            async_waiters.remove((loop, waiter))
+            except asyncio.CancelledError:
+                with self.mutex:
+                    if (loop, waiter) in async_waiters:
+                        async_waiters.remove((loop, waiter))
+                    elif predicate():
+                        # The wakeup meant for this coroutine goes to the next waiter.
+                        self._notify(self.item_added if async_waiters is self.async_getters
+                                     else self.item_removed, async_waiters)
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    async def async_get(self):
+        """Remove and return an item, waiting in the event loop instead of blocking a thread."""
+        await self._async_wait(self._ready, self.async_getters, self._ready_in)
+        try:
+            item = self._get()
+            self._item_removed()
+            return item
+        finally:
+            self.mutex.release()
+
+    async def async_put(self, item):
+        """Put an item, waiting in the event loop while the queue is full."""
+        await self._async_wait(self._free_slots, self.async_putters)
+        try:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self._item_added()
+        finally:
+            self.mutex.release()
+
     def qsize(self):
         with self.mutex:
             return self._qsize()
@@ -66,42 +183,114 @@ class Queue:
                 self.all_tasks_done.wait()
     
     def put(self, item, block=True, timeout=None):
-        with self.item_added:
-            if not block:
-                if self._qsize() >= self.maxsize:
-                    raise Full
-            elif timeout is None:
-                while self._qsize() >= self.maxsize:
-                    self.item_removed.wait()
-            elif timeout < 0:
-                raise ValueError('timeout must be greater than 0')
-            else:
-                endtime = time() + timeout
-                while self._qsize() >= self.maxsize:
-                    remaining = endtime - time()
-                    if remaining <= 0.0:
-                        raise Full
-                    self.item_removed.wait(timeout)
+        with self.mutex:
+            self._wait(self.item_removed, self._free_slots, block, timeout, Full)
             self._put(item)
-            self.item_added.notify_all()
             self.unfinished_tasks += 1
+            self._item_added()
 
     def get(self, block=True, timeout=None):
-        with self.item_removed:
-            if not block:
-                if self._qsize() == 0:
-                    raise Empty
-            elif timeout is None:
-                while not self._qsize():
-                    self.item_added.wait()
-            elif timeout < 0:
-                raise ValueError('timeout must be greater than 0')
-            else:
-                endtime = time() + timeout
-                while not self._qsize():
-                    remaining = endtime - time()
-                    if remaining <= 0.0:
-                        raise Empty
-                    self.item_added.wait(timeout)
-            self.item_removed.notify_all()
-            return self._get()
+        with self.mutex:
+            self._wait(self.item_added, self._ready, block, timeout, Empty, self._ready_in)
+            item = self._get()
+            self._item_removed()
+            return item
+
+    def put_many(self, items, timeout=None):
+        """Put all items, taking the lock once per batch that fits into the queue.
+
+        Raises Full if timeout expires first; the items put until then stay queued.
+        """
+        items = list(items)
+        endtime = None if timeout is None else time() + timeout
+        position = 0
+        with self.mutex:
+            while position < len(items):
+                remaining = None if endtime is None else max(endtime - time(), 0)
+                self._wait(self.item_removed, self._free_slots, True, remaining, Full)
+                count = min(self._free_slots(), len(items) - position)
+                for item in items[position:position + count]:
+                    self._put(item)
+                position += count
+                self.unfinished_tasks += count
+                self._item_added(count)
+
+    def get_many(self, max_items, timeout=None):
+        """Return a list of 1 to max_items items under a single lock acquisition.
+
+        Blocks until at least one item is available; raises Empty if timeout expires first.
+        """
+        if max_items < 1:
+            raise ValueError('max_items must be greater than 0')
+        with self.mutex:
+            self._wait(self.item_added, self._ready, True, timeout, Empty, self._ready_in)
+            items = [self._get()]
+            while len(items) < max_items and self._ready():
+                items.append(self._get())
+            self._item_removed(len(items))
+            return items
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class LifoQueue(Queue):
+    """Hands out the most recently added item first."""
+
+    def _get(self):
+        return self.queue.pop()
+
+
+class PriorityQueue(Queue):
+    """Hands out the smallest item first, items are usually (priority, data) tuples."""
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.queue = []
+
+    def _put(self, item):
+        heappush(self.queue, item)
+
+    def _get(self):
+        return heappop(self.queue)
+
+
+class DelayQueue(Queue):
+    """Hands out items once their delay has passed, the earliest due first.
+
+    A blocking get sleeps until the next item is due, or until a put
+    brings an earlier one, instead of polling.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.queue = []
+        self._counter = count()
+
+    def _put(self, item):
+        due, value = item
+        heappush(self.queue, (due, next(self._counter), value))
+
+    def _get(self):
+        return heappop(self.queue)[-1]
+
+    def _ready(self):
+        return bool(self.queue) and self.queue[0][0] <= time()
+
+    def _ready_in(self):
+        if not self.queue:
+            return None
+        return max(self.queue[0][0] - time(), 0)
+
+    def put(self, item, block=True, timeout=None, delay=0):
+        """Put item to be handed out no earlier than delay seconds from now."""
+        super().put((time() + delay, item), block, timeout)
+
+    def put_many(self, items, timeout=None, delay=0):
+        due = time() + delay
+        super().put_many([(due, item) for item in items], timeout)
+
+    async def async_put(self, item, delay=0):
+        await super().async_put((time() + delay, item))
@@ -0,0 +1,223 @@
+import os
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import suppress
+from time import monotonic as time
+import analyze
+from thread_pool import ThreadPoolExecutor
+
+
+_STATUS = '''Name:\t{name}
+Umask:\t0022
+State:\t{state}
+Tgid:\t{pid}
+Ngid:\t0
+Pid:\t{pid}
+PPid:\t{ppid}
+TracerPid:\t0
+Uid:\t{uid}\t{uid}\t{uid}\t{uid}
+Gid:\t{uid}\t{uid}\t{uid}\t{uid}
+FDSize:\t64
+Groups:\t
+VmPeak:\t    2508 kB
+VmSize:\t    2508 kB
+VmRSS:\t    1476 kB
+Threads:\t1
+SigQ:\t0/23959
+SigPnd:\t0000000000000000
+ShdPnd:\t0000000000000000
+SigBlk:\t0000000000000000
+SigIgn:\t0000000000000000
+SigCgt:\t0000000000000000
+CapInh:\t0000000000000000
+CapPrm:\t000001fffeffffff
+CapEff:\t000001fffeffffff
+CapBnd:\t000001fffeffffff
+CapAmb:\t0000000000000000
+NoNewPrivs:\t0
+Seccomp:\t0
+Cpus_allowed:\t1
+Cpus_allowed_list:\t0
+voluntary_ctxt_switches:\t0
+nonvoluntary_ctxt_switches:\t0
+'''
+
+_STATES = ['S (sleeping)', 'R (running)', 'D (disk sleep)', 'I (idle)']
+
+
+def _add_process(folder, pid, ppid):
+    os.mkdir(os.path.join(folder, str(pid)))
+    status = _STATUS.format(name=f'worker-{pid % 97}', state=_STATES[pid % len(_STATES)],
+                            pid=pid, ppid=ppid, uid=1000 + pid % 13)
+    with open(os.path.join(folder, str(pid), 'status'), 'w') as file:
+        file.write(status)
+
+
+def make_fixture(folder, processes, descriptors=0, files=1000):
+    """Fill folder with processes fake /proc/<pid>/status files forming a tree.
+
+    With descriptors, every process also gets that many fd symlinks to
+    files spread over folder/files/0..files-1.
+    """
+    targets = os.path.join(folder, 'files')
+    if descriptors:
+        os.mkdir(targets)
+        for index in range(files):
+            open(os.path.join(targets, str(index)), 'w').close()
+    for pid in range(1, processes + 1):
+        _add_process(folder, pid, pid // 8)
+        if descriptors:
+            fd_folder = os.path.join(folder, str(pid), 'fd')
+            os.mkdir(fd_folder)
+            for fd in range(descriptors):
+                os.symlink(os.path.join(targets, str((pid * descriptors + fd) % files)),
+                           os.path.join(fd_folder, str(fd)))
+    for name in ('self', 'meminfo', 'sys'):
+        os.mkdir(os.path.join(folder, name))
+
+
+def _legacy_entries(folder):
+    # The scan get_entries did before scan_processes: listdir, exists and
+    # readlines per pid, fields picked by line index.
+    entries = {}
+    for process_id in [id for id in os.listdir(folder) if id.isnumeric()]:
+        with suppress(IOError):
+            process_path = os.path.join(folder, process_id)
+            if os.path.exists(process_path):
+                state, ppid = analyze.get_ppid_state(os.path.join(process_path, 'status'))
+                entries[process_id] = (ppid, state)
+    return entries
+
+
+def _legacy_find_processes_with_file(folder, filename):
+    # find_processes_with_file before OpenFileIndex: a full walk per file.
+    filepath = os.path.abspath(filename)
+    processes = []
+    for process_id in [id for id in os.listdir(folder) if id.isnumeric()]:
+        fd_path = os.path.join(folder, process_id, 'fd')
+        for descriptor in os.listdir(fd_path):
+            path_to_descriptor = os.path.join(fd_path, descriptor)
+            if os.path.exists(path_to_descriptor) and os.readlink(path_to_descriptor) == filepath:
+                processes.append(process_id)
+    return processes
+
+
+def _measure(name, scan, processes):
+    start = time()
+    count = len(scan())
+    elapsed = time() - start
+    assert count == processes, count
+    print(f'{name:>22}: {processes} processes in {elapsed:.3f}s, {processes / elapsed:,.0f} per second')
+
+
+def bench_scan(processes, workers):
+    with tempfile.TemporaryDirectory() as folder:
+        make_fixture(folder, processes)
+        _measure('legacy get_entries', lambda: _legacy_entries(folder), processes)
+        _measure('scan_processes', lambda: analyze.scan_processes(folder), processes)
+        with ThreadPoolExecutor(workers) as executor:
+            _measure(f'scan_processes x{workers}', lambda: analyze.scan_processes(folder, executor), processes)
+
+
+def bench_track(processes, churn, polls):
+    with tempfile.TemporaryDirectory() as folder:
+        make_fixture(folder, processes)
+        tracker = analyze.ProcessTreeTracker(folder, full_rescan_every=0)
+        tracker.refresh()
+        rebuild = track = 0
+        next_pid = processes + 1
+        for poll in range(polls):
+            # Short-lived leaf processes come and go under pid 1.
+            for pid in range(next_pid - churn, next_pid):
+                if pid > processes:
+                    shutil.rmtree(os.path.join(folder, str(pid)))
+            for pid in range(next_pid, next_pid + churn):
+                _add_process(folder, pid, 1)
+            next_pid += churn
+            start = time()
+            tree = analyze.processes_tree(folder)
+            rebuild += time() - start
+            start = time()
+            tracker.refresh()
+            track += time() - start
+            assert tracker.tree == tree
+        print(f'{processes} processes, {churn} started and exited per poll, {polls} polls')
+        print(f'    processes_tree: {rebuild / polls * 1000:,.1f}ms per poll')
+        print(f'ProcessTreeTracker: {track / polls * 1000:,.1f}ms per poll')
+
+
+def bench_files(processes, descriptors, queries):
+    with tempfile.TemporaryDirectory() as folder:
+        make_fixture(folder, processes, descriptors)
+        filenames = [os.path.join(folder, 'files', str(index)) for index in range(queries)]
+        start = time()
+        legacy = {filename: _legacy_find_processes_with_file(folder, filename) for filename in filenames[:5]}
+        legacy_elapsed = (time() - start) / 5 * queries
+        start = time()
+        index = analyze.OpenFileIndex(folder)
+        built = time() - start
+        found = index.lookup(filenames)
+        elapsed = time() - start
+        assert all(sorted(map(int, pids)) == found[filename] for filename, pids in legacy.items())
+        print(f'{processes} processes with {descriptors} descriptors each, {queries} files asked for')
+        print(f'find_processes_with_file per file: {legacy_elapsed:.2f}s (extrapolated from 5 files)')
+        print(f'    OpenFileIndex build and lookup: {elapsed:.2f}s, {built:.2f}s of it building')
+
+
+def _legacy_find_processes_with_user(folder, uid):
+    # find_processes_with_user before ProcessIndex: a full scan per call.
+    processes = []
+    for process_id in [id for id in os.listdir(folder) if id.isnumeric()]:
+        status_path = os.path.join(folder, process_id, 'status')
+        if os.path.exists(status_path):
+            name, cur_uid = analyze.get_name_uid(status_path)
+            if int(cur_uid) == uid:
+                processes.append((process_id, name))
+    return processes
+
+
+def bench_index(processes, queries):
+    with tempfile.TemporaryDirectory() as folder:
+        make_fixture(folder, processes)
+        start = time()
+        legacy = _legacy_find_processes_with_user(folder, 1000)
+        legacy_elapsed = time() - start
+        start = time()
+        index = analyze.ProcessIndex(folder)
+        built = time() - start
+        del index
+        tracemalloc.start()
+        index = analyze.ProcessIndex(folder)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert sorted(int(pid) for pid, _ in legacy) == [entry.pid for entry in index.query(uid=1000)]
+        start = time()
+        for _ in range(queries):
+            index.query(uid=[1000, 1001], state='D')
+        elapsed = time() - start
+        print(f'{processes} processes')
+        print(f'find_processes_with_user scan: {legacy_elapsed * 1000:,.0f}ms per query')
+        print(f'ProcessIndex: built in {built * 1000:,.0f}ms, {memory / 2 ** 20:.1f} MiB, '
+              f'{elapsed / queries * 1000:,.2f}ms per query of two users in state D')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='analyze benchmarks on a synthetic /proc')
+    parser.add_argument('bench', choices=['scan', 'track', 'files', 'index'], help='benchmark to run')
+    parser.add_argument('-processes', '--processes', type=int, default=50000, help='processes in the fixture')
+    parser.add_argument('-workers', '--workers', type=int, default=4, help='threads of the parallel scan')
+    parser.add_argument('-churn', '--churn', type=int, default=50, help='processes started and exited per poll')
+    parser.add_argument('-polls', '--polls', type=int, default=5, help='polls of the track benchmark')
+    parser.add_argument('-descriptors', '--descriptors', type=int, default=16, help='open files per process')
+    parser.add_argument('-queries', '--queries', type=int, default=500, help='files looked up')
+    arguments = parser.parse_args()
+    if arguments.bench == 'scan':
+        bench_scan(arguments.processes, arguments.workers)
+    elif arguments.bench == 'track':
+        bench_track(arguments.processes, arguments.churn, arguments.polls)
+    elif arguments.bench == 'files':
+        bench_files(arguments.processes, arguments.descriptors, arguments.queries)
+    elif arguments.bench == 'index':
+        bench_index(arguments.processes, arguments.queries)
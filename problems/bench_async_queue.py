@@ -0,0 +1,70 @@
+import queue
+import argparse
+import threading
+import importlib
+from time import monotonic as time
+
+async_queue = importlib.import_module('async-queue')
+
+
+def _produce(put, items):
+    for item in range(items):
+        put(item)
+
+
+def _produce_batches(put_many, items, batch):
+    for start in range(0, items, batch):
+        put_many(range(start, min(start + batch, items)))
+
+
+def _consume(get, items):
+    for _ in range(items):
+        get()
+
+
+def _consume_batches(get_many, items, batch):
+    received = 0
+    while received < items:
+        received += len(get_many(min(batch, items - received)))
+
+
+def _run(producers, consumers):
+    threads = [threading.Thread(target=target, args=args) for target, args in producers + consumers]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time() - start
+
+
+def bench_contention(threads, items, maxsize, batch):
+    per_thread = items // threads
+    cases = [
+        ('queue.Queue', queue.Queue(maxsize), False),
+        ('Queue', async_queue.Queue(maxsize), False),
+        (f'Queue batch={batch}', async_queue.Queue(maxsize), True),
+    ]
+    for name, tested, batched in cases:
+        if batched:
+            producers = [(_produce_batches, (tested.put_many, per_thread, batch))] * threads
+            consumers = [(_consume_batches, (tested.get_many, per_thread, batch))] * threads
+        else:
+            producers = [(_produce, (tested.put, per_thread))] * threads
+            consumers = [(_consume, (tested.get, per_thread))] * threads
+        elapsed = _run(producers, consumers)
+        total = per_thread * threads
+        print(f'{name:>18}: {threads}x{threads} threads, {total} items in {elapsed:.3f}s, '
+              f'{total / elapsed:,.0f} items/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='async-queue benchmarks')
+    parser.add_argument('bench', choices=['contention'], help='benchmark to run')
+    parser.add_argument('-threads', '--threads', type=int, default=32, help='producers and consumers each')
+    parser.add_argument('-items', '--items', type=int, default=320000, help='total number of items')
+    parser.add_argument('-maxsize', '--maxsize', type=int, default=1000, help='queue capacity')
+    parser.add_argument('-batch', '--batch', type=int, default=64, help='items per put_many/get_many')
+    arguments = parser.parse_args()
+    if arguments.bench == 'contention':
+        bench_contention(arguments.threads, arguments.items, arguments.maxsize, arguments.batch)
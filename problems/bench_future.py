@@ -0,0 +1,242 @@
+import sys
+import argparse
+import threading
+import tracemalloc
+
+# The local subprocess.py shadows the standard library module asyncio
+# imports, so asyncio has to be imported before this directory is searched.
+_here = sys.path.pop(0)
+import asyncio
+sys.path.insert(0, _here)
+
+from threading import Condition, RLock
+from time import monotonic as time
+import thread_pool
+from future import Future, as_completed, wait, InvalidStateError, CancelledError, PENDING, RUNNING, CANCELLED, FINISHED
+from thread_pool import ThreadPoolExecutor, AsyncioExecutor
+
+
+class _LockedFuture:
+    """future.Future as it was before it got compact: a Condition(RLock())
+    and a callback list per instance, and a lock taken on every read."""
+
+    def __init__(self):
+        self._done_condition = Condition(RLock())
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._done_callbacks = []
+
+    def __invoke_callbacks(self):
+        for callback in self._done_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                print('exception calling callback')
+
+    def __get_result(self):
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def __result(self):
+        if self._state == CANCELLED:
+            raise CancelledError()
+        if self._state == FINISHED:
+            return self.__get_result()
+
+    def __wait(self, timeout):
+        if not self._done_condition.wait_for(self.__is_done, timeout):
+            raise TimeoutError()
+
+    def __is_done(self):
+        return self._state in [CANCELLED, FINISHED]
+
+    def result(self, timeout=None):
+        with self._done_condition:
+            self.__wait(timeout)
+            return self.__result()
+
+    def set_result(self, result):
+        with self._done_condition:
+            if self._state in [CANCELLED, FINISHED]:
+                raise InvalidStateError()
+            self._result = result
+            self._state = FINISHED
+            self._done_condition.notify_all()
+        self.__invoke_callbacks()
+
+    def add_done_callback(self, callback):
+        with self._done_condition:
+            if self._state in [PENDING, RUNNING]:
+                self._done_callbacks.append(callback)
+                return
+        try:
+            callback(self)
+        except Exception:
+            print('exception calling callback')
+
+    def running(self):
+        with self._done_condition:
+            return self._state == RUNNING
+
+    def done(self):
+        with self._done_condition:
+            return self._state in [CANCELLED, FINISHED]
+
+    def cancel(self):
+        with self._done_condition:
+            if self._state in [RUNNING, FINISHED]:
+                return False
+            if self._state == CANCELLED:
+                return True
+            self._state = CANCELLED
+            self._done_condition.notify_all()
+        self.__invoke_callbacks()
+        return True
+
+    def canceled(self):
+        with self._done_condition:
+            return self._state == CANCELLED
+
+    def __exception(self):
+        if self._state == CANCELLED:
+            raise CancelledError()
+        if self._state == FINISHED:
+            return self._exception
+
+    def exception(self, timeout=None):
+        with self._done_condition:
+            self.__wait(timeout)
+            return self.__exception()
+
+    def set_exception(self, exception):
+        with self._done_condition:
+            if self._state in [CANCELLED, FINISHED]:
+                raise InvalidStateError()
+            self._exception = exception
+            self._state = FINISHED
+            self._done_condition.notify_all()
+        self.__invoke_callbacks()
+
+    def set_running(self):
+        with self._done_condition:
+            if self._state == PENDING:
+                self._state = RUNNING
+                return True
+            return False
+
+
+def _complete(futures):
+    for index, future in enumerate(futures):
+        future.set_result(index)
+
+
+async def _await_futures(count):
+    futures = [Future() for _ in range(count)]
+    completer = threading.Thread(target=_complete, args=(futures,))
+    start = time()
+    awaiting = asyncio.gather(*(_await(future) for future in futures))
+    await asyncio.sleep(0)
+    threads = threading.active_count()
+    completer.start()
+    results = await awaiting
+    completer.join()
+    return time() - start, threads, sum(results)
+
+
+async def _await(future):
+    return await future
+
+
+async def _run_in_executor(count, workers):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(workers) as executor:
+        adapter = AsyncioExecutor(executor)
+        start = time()
+        await asyncio.gather(*(loop.run_in_executor(adapter, abs, -index) for index in range(count)))
+        return time() - start, threading.active_count()
+
+
+def bench_await(count, workers):
+    elapsed, threads, _ = asyncio.run(_await_futures(count))
+    print(f'await Future: {count} concurrent awaits in {elapsed:.3f}s, {threads} threads while waiting')
+    elapsed, threads = asyncio.run(_run_in_executor(count, workers))
+    print(f'run_in_executor: {count} tasks in {elapsed:.3f}s, {threads} threads')
+
+
+def _complete_reversed(futures):
+    for index, future in enumerate(reversed(futures)):
+        future.set_result(index)
+
+
+def bench_wait(count):
+    for size in (count // 10, count):
+        for name, consume in (('as_completed', lambda futures: sum(1 for _ in as_completed(futures))),
+                              ('wait', lambda futures: len(wait(futures)[0]))):
+            futures = [Future() for _ in range(size)]
+            completer = threading.Thread(target=_complete_reversed, args=(futures,))
+            start = time()
+            completer.start()
+            consume(futures)
+            elapsed = time() - start
+            completer.join()
+            print(f'{name:>12}: {size} futures in {elapsed:.3f}s, {elapsed / size * 1e9:,.0f}ns per future')
+
+
+def _memory_per_future(future_class, count):
+    tracemalloc.start()
+    futures = [future_class() for _ in range(count)]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del futures
+    return used / count
+
+
+def _complete_cycle(future_class, count):
+    start = time()
+    for index in range(count):
+        future = future_class()
+        future.set_running()
+        future.set_result(index)
+        future.done()
+        future.result()
+    return (time() - start) / count
+
+
+def _submits_per_second(future_class, count, workers):
+    # The pool creates its futures through the name it imported.
+    thread_pool.Future = future_class
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            start = time()
+            futures = [executor.submit(abs, -index) for index in range(count)]
+            for future in futures:
+                future.result()
+            elapsed = time() - start
+    finally:
+        thread_pool.Future = Future
+    return count / elapsed
+
+
+def bench_compact(count, workers):
+    for name, future_class in (('before', _LockedFuture), ('after', Future)):
+        memory = _memory_per_future(future_class, count)
+        cycle = _complete_cycle(future_class, count)
+        submits = _submits_per_second(future_class, count, workers)
+        print(f'{name:>6}: {memory:,.0f} bytes per future, {cycle * 1e9:,.0f}ns per create/complete/read, '
+              f'ThreadPoolExecutor {submits:,.0f} submit/complete per second')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='future.Future benchmarks')
+    parser.add_argument('bench', choices=['await', 'wait', 'compact'], help='benchmark to run')
+    parser.add_argument('-count', '--count', type=int, default=10000, help='number of futures')
+    parser.add_argument('-workers', '--workers', type=int, default=4, help='number of worker threads')
+    arguments = parser.parse_args()
+    if arguments.bench == 'await':
+        bench_await(arguments.count, arguments.workers)
+    elif arguments.bench == 'wait':
+        bench_wait(arguments.count)
+    elif arguments.bench == 'compact':
+        bench_compact(arguments.count, arguments.workers)
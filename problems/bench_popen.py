@@ -0,0 +1,158 @@
+import os
+import sys
+import argparse
+import tempfile
+
+# The local subprocess.py shadows the standard library module this
+# benchmark compares against, so it has to be imported first.
+_here = sys.path.pop(0)
+import subprocess
+sys.path.insert(0, _here)
+
+from time import monotonic as time
+import popen
+from popen import Popen
+from pipeline import Pipeline
+from future import wait
+from command_executor import CommandExecutor
+
+
+def _output_command(size, stderr_size):
+    # stderr is written first and is bigger than a pipe buffer, so reading
+    # stdout to the end before stderr would deadlock.
+    return ['sh', '-c', f'head -c {stderr_size} /dev/zero >&2; head -c {size} /dev/zero']
+
+
+def _run_popen(command):
+    with Popen(command, stdout=Popen.PIPE, stderr=Popen.PIPE) as process:
+        return process.communicate()
+
+
+def _run_subprocess(command):
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.stdout, result.stderr
+
+
+def bench_communicate(size, stderr_size):
+    command = _output_command(size, stderr_size)
+    for name, run in (('popen.Popen', _run_popen), ('subprocess.run', _run_subprocess)):
+        start = time()
+        stdout, stderr = run(command)
+        elapsed = time() - start
+        assert len(stdout) == size and len(stderr) == stderr_size
+        del stdout, stderr
+        megabytes = (size + stderr_size) / 2 ** 20
+        print(f'{name:>14}: {megabytes:,.0f} MiB in {elapsed:.3f}s, {megabytes / elapsed:,.0f} MiB/s')
+
+
+def _spawns_per_second(count):
+    start = time()
+    for _ in range(count):
+        with Popen(['true']) as process:
+            process.wait()
+    return count / (time() - start)
+
+
+def _growing_rss(max_rss):
+    """Yield the extra resident memory of this process, doubling it up to max_rss."""
+    ballast = []
+    size = 0
+    while True:
+        yield size
+        if size >= max_rss:
+            break
+        # bytearray zero fills its memory, so the ballast is resident, not just reserved.
+        ballast.append(bytearray(max(size, 2 ** 26)))
+        size += len(ballast[-1])
+
+
+def bench_spawn(count, max_rss):
+    for size in _growing_rss(max_rss):
+        rates = []
+        for use_posix_spawn in (False, True):
+            popen._USE_POSIX_SPAWN = use_posix_spawn
+            rates.append(_spawns_per_second(count))
+        print(f'{size / 2 ** 20:>6,.0f} MiB extra RSS: fork {rates[0]:,.0f}/s, posix_spawn {rates[1]:,.0f}/s')
+
+def _pump_through_python(size):
+    with Popen(['head', '-c', str(size), '/dev/zero'], stdout=Popen.PIPE) as source:
+        with Popen(['wc', '-c'], stdin=Popen.PIPE, stdout=Popen.PIPE) as sink:
+            while chunk := source.outread.read(2 ** 16):
+                sink.inwrite.write(chunk)
+            sink.inwrite.close()
+            return sink.outread.read()
+
+
+def _pipeline(size, taps=None):
+    with Pipeline([['head', '-c', str(size), '/dev/zero'], ['wc', '-c']], stdout=Popen.PIPE, taps=taps) as pipeline:
+        return pipeline.stdout.read()
+
+
+def _tapped_pipeline(size):
+    with tempfile.TemporaryFile() as tap:
+        return _pipeline(size, {0: tap})
+
+
+def bench_pipeline(size):
+    for name, run in (('python pump', _pump_through_python), ('Pipeline', _pipeline),
+                      ('Pipeline+tap', _tapped_pipeline)):
+        cpu_before = os.times()
+        start = time()
+        assert int(run(size)) == size
+        elapsed = time() - start
+        cpu_after = os.times()
+        cpu = cpu_after.user + cpu_after.system - cpu_before.user - cpu_before.system
+        megabytes = size / 2 ** 20
+        print(f'{name:>12}: {megabytes:,.0f} MiB in {elapsed:.3f}s, {megabytes / elapsed:,.0f} MiB/s, '
+              f'{cpu:.3f}s CPU in this process')
+
+
+def _run_captured(count, cwd):
+    start = time()
+    for _ in range(count):
+        with Popen(['true'], stdout=Popen.PIPE, stderr=Popen.PIPE, cwd=cwd) as process:
+            process.communicate()
+    return count / (time() - start)
+
+
+def _run_executor(executor, count, cwd):
+    start = time()
+    for _ in range(count):
+        executor.submit(['true'], cwd=cwd).result()
+    return count / (time() - start)
+
+
+def bench_executor(count, workers, max_rss):
+    # Popen has to fork when a cwd is given, CommandExecutor hands those
+    # commands to its helper, which was started before this process grew.
+    cwd = os.getcwd()
+    with CommandExecutor(workers) as executor:
+        for size in _growing_rss(max_rss):
+            rates = [_run_captured(count, None), _run_captured(count, cwd),
+                     _run_executor(executor, count, None), _run_executor(executor, count, cwd)]
+            start = time()
+            wait([executor.submit(['true'], cwd=cwd) for _ in range(count)])
+            rates.append(count / (time() - start))
+            print(f'{size / 2 ** 20:>6,.0f} MiB extra RSS: Popen {rates[0]:,.0f}/s, with cwd {rates[1]:,.0f}/s; '
+                  f'CommandExecutor {rates[2]:,.0f}/s, with cwd {rates[3]:,.0f}/s, '
+                  f'{rates[4]:,.0f}/s {workers} at a time')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='popen.Popen benchmarks')
+    parser.add_argument('bench', choices=['communicate', 'spawn', 'pipeline', 'executor'], help='benchmark to run')
+    parser.add_argument('-size', '--size', type=int, default=2 ** 30, help='bytes the child writes to stdout')
+    parser.add_argument('-stderr-size', '--stderr-size', type=int, default=2 ** 20,
+                        help='bytes the child writes to stderr')
+    parser.add_argument('-count', '--count', type=int, default=200, help='spawns per measurement')
+    parser.add_argument('-workers', '--workers', type=int, default=8, help='concurrent commands of the executor')
+    parser.add_argument('-max-rss', '--max-rss', type=int, default=2 ** 31, help='extra memory to grow the parent to')
+    arguments = parser.parse_args()
+    if arguments.bench == 'communicate':
+        bench_communicate(arguments.size, arguments.stderr_size)
+    elif arguments.bench == 'spawn':
+        bench_spawn(arguments.count, arguments.max_rss)
+    elif arguments.bench == 'pipeline':
+        bench_pipeline(arguments.size)
+    elif arguments.bench == 'executor':
+        bench_executor(arguments.count, arguments.workers, arguments.max_rss)
@@ -0,0 +1,49 @@
+import argparse
+from time import monotonic as time
+from thread_pool import ThreadPoolExecutor
+from process_pool import ProcessPoolExecutor
+
+
+def _count(limit):
+    total = 0
+    for value in range(limit):
+        total += value
+    return total
+
+
+def _echo(payload):
+    return payload
+
+
+def bench_cpu(workers, tasks, limit):
+    for name, executor_class in (('threads', ThreadPoolExecutor), ('processes', ProcessPoolExecutor)):
+        with executor_class(workers) as executor:
+            start = time()
+            list(executor.map(_count, [limit] * tasks))
+            elapsed = time() - start
+        print(f'{name:>10}: {tasks} x count({limit}) in {elapsed:.3f}s')
+
+
+def bench_payload(workers, tasks, size):
+    payload = b'x' * size
+    for name, threshold in (('socket', size + 1), ('shared memory', size)):
+        with ProcessPoolExecutor(workers, shared_memory_threshold=threshold) as executor:
+            start = time()
+            list(executor.map(_echo, [payload] * tasks))
+            elapsed = time() - start
+        megabytes = 2 * tasks * size / 2 ** 20
+        print(f'{name:>14}: {megabytes:.0f} MiB round trip in {elapsed:.3f}s, {megabytes / elapsed:,.0f} MiB/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ProcessPoolExecutor benchmarks')
+    parser.add_argument('bench', choices=['cpu', 'payload'], help='benchmark to run')
+    parser.add_argument('-workers', '--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('-tasks', '--tasks', type=int, default=16, help='number of tasks')
+    parser.add_argument('-limit', '--limit', type=int, default=2000000, help='loop length of cpu tasks')
+    parser.add_argument('-size', '--size', type=int, default=32 * 2 ** 20, help='payload size in bytes')
+    arguments = parser.parse_args()
+    if arguments.bench == 'cpu':
+        bench_cpu(arguments.workers, arguments.tasks, arguments.limit)
+    elif arguments.bench == 'payload':
+        bench_payload(arguments.workers, arguments.tasks, arguments.size)
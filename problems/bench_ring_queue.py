@@ -0,0 +1,75 @@
+import os
+import struct
+import argparse
+from time import monotonic as time
+from ring_queue import RingQueue
+
+_LENGTH = struct.Struct('<I')
+
+
+def _read_exactly(fd, size):
+    data = b''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _pipe_transfer(messages, payload):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        record = _LENGTH.pack(len(payload)) + payload
+        for _ in range(messages):
+            os.write(write_fd, record)
+        os._exit(0)
+    os.close(write_fd)
+    start = time()
+    for _ in range(messages):
+        size, = _LENGTH.unpack(_read_exactly(read_fd, _LENGTH.size))
+        _read_exactly(read_fd, size)
+    elapsed = time() - start
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return elapsed
+
+
+def _ring_transfer(messages, payload, capacity, single):
+    with RingQueue(capacity, multi_producer=not single, multi_consumer=not single) as queue:
+        pid = os.fork()
+        if pid == 0:
+            for _ in range(messages):
+                queue.put(payload)
+            os._exit(0)
+        start = time()
+        for _ in range(messages):
+            queue.get()
+        elapsed = time() - start
+        os.waitpid(pid, 0)
+    return elapsed
+
+
+def bench_transfer(messages, size, capacity):
+    payload = b'x' * size
+    cases = [
+        ('pipe', lambda: _pipe_transfer(messages, payload)),
+        ('RingQueue', lambda: _ring_transfer(messages, payload, capacity, False)),
+        ('RingQueue spsc', lambda: _ring_transfer(messages, payload, capacity, True)),
+    ]
+    for name, run in cases:
+        elapsed = run()
+        print(f'{name:>15}: {messages} x {size} bytes in {elapsed:.3f}s, {messages / elapsed:,.0f} messages/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RingQueue benchmarks')
+    parser.add_argument('bench', choices=['transfer'], help='benchmark to run')
+    parser.add_argument('-messages', '--messages', type=int, default=200000, help='number of messages')
+    parser.add_argument('-size', '--size', type=int, default=64, help='message size in bytes')
+    parser.add_argument('-capacity', '--capacity', type=int, default=1 << 20, help='ring capacity in bytes')
+    arguments = parser.parse_args()
+    if arguments.bench == 'transfer':
+        bench_transfer(arguments.messages, arguments.size, arguments.capacity)
@@ -0,0 +1,182 @@
+import argparse
+import threading
+import tracemalloc
+import thread_pool
+from queue import Empty
+from time import monotonic as time, sleep
+from future import Future
+from thread_pool import ThreadPoolExecutor, _run_work_item, _run_measured_work_item
+from telemetry import Telemetry
+
+
+def _leaf(value):
+    return value * value + 1
+
+
+def _fan_out(executor, width):
+    return [executor.submit(_leaf, value) for value in range(width)]
+
+
+def fan_out_fan_in(executor, roots, width):
+    parents = [executor.submit(_fan_out, executor, width) for _ in range(roots)]
+    total = 0
+    for parent in parents:
+        for child in parent.result():
+            total += child.result()
+    return total
+
+
+def bench_work_stealing(workers, roots, width):
+    for work_stealing in (False, True):
+        with ThreadPoolExecutor(workers, work_stealing=work_stealing) as executor:
+            start = time()
+            fan_out_fan_in(executor, roots, width)
+            elapsed = time() - start
+        tasks = roots * (width + 1)
+        mode = 'work-stealing' if work_stealing else 'single-queue'
+        print(f'{mode:>14}: {tasks} tasks in {elapsed:.3f}s, {tasks / elapsed:,.0f} tasks/s')
+
+
+def _map_eagerly(executor, task, items):
+    futures = [executor.submit(task, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def bench_map(workers, items, chunksize):
+    cases = [
+        ('eager submit', lambda executor: _map_eagerly(executor, _leaf, range(items))),
+        ('map', lambda executor: sum(executor.map(_leaf, range(items)))),
+        (f'map chunk={chunksize}', lambda executor: sum(executor.map(_leaf, range(items), chunksize=chunksize))),
+        (f'unordered chunk={chunksize}',
+            lambda executor: sum(executor.map_unordered(_leaf, range(items), chunksize=chunksize))),
+    ]
+    for name, run in cases:
+        with ThreadPoolExecutor(workers) as executor:
+            tracemalloc.start()
+            start = time()
+            run(executor)
+            elapsed = time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print(f'{name:>20}: {items} items in {elapsed:.3f}s, peak memory {peak / 2 ** 20:.1f} MiB')
+
+
+def _io_task(started):
+    sleep(0.005)
+    return time() - started
+
+
+def bench_scaling(workers, bursts, burst_size, pause):
+    for keep_alive in (None, pause / 4):
+        with ThreadPoolExecutor(workers, keep_alive=keep_alive) as executor:
+            latencies = []
+            idle_threads = []
+            for _ in range(bursts):
+                futures = [executor.submit(_io_task, time()) for _ in range(burst_size)]
+                latencies.extend(future.result() for future in futures)
+                sleep(pause)
+                idle_threads.append(threading.active_count() - 1)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(f'keep_alive={keep_alive}: threads between bursts {max(idle_threads)}, '
+              f'p99 latency {p99 * 1000:.1f}ms')
+
+
+def _noop():
+    return 1
+
+
+def _plain_worker(executor, index=None):
+    # The worker loop as it was before telemetry, without the telemetry branch.
+    queue = executor._work_queue
+    if index is not None:
+        thread_pool._worker_context.queue = queue
+        thread_pool._worker_context.index = index
+    while True:
+        executor._add_idle(1)
+        while True:
+            try:
+                work_item = queue.get(timeout=executor._keep_alive)
+                break
+            except Empty:
+                if executor._retire_thread():
+                    return
+        executor._add_idle(-1)
+        if not work_item:
+            break
+        _run_work_item(work_item)
+
+
+def _bench_run_work_item(items, mode):
+    work_items = [(Future(), _noop, (), {}, None, 0) for _ in range(items)]
+    telemetry = Telemetry() if mode == 'enabled' else None
+    start = time()
+    if mode == 'plain':
+        for work_item in work_items:
+            _run_work_item(work_item)
+    else:
+        for work_item in work_items:
+            if telemetry is None:
+                _run_work_item(work_item)
+            else:
+                _run_measured_work_item(work_item, telemetry)
+    return time() - start
+
+
+def _bench_pool(workers, items, mode):
+    worker = thread_pool._worker
+    if mode == 'plain':
+        thread_pool._worker = _plain_worker
+    try:
+        telemetry = Telemetry() if mode == 'enabled' else None
+        with ThreadPoolExecutor(workers, telemetry=telemetry) as executor:
+            start = time()
+            futures = [executor.submit(_noop) for _ in range(items)]
+            for future in futures:
+                future.result()
+            elapsed = time() - start
+            stats = executor.stats()
+    finally:
+        thread_pool._worker = worker
+    return elapsed, stats
+
+
+def bench_telemetry(workers, items):
+    modes = ('plain', 'disabled', 'enabled')
+    print('worker step per task (plain is the loop without the telemetry branch):')
+    plain = _bench_run_work_item(items, 'plain')
+    for mode in modes:
+        elapsed = plain if mode == 'plain' else _bench_run_work_item(items, mode)
+        print(f'{mode:>9}: {elapsed / items * 1e9:,.0f}ns per task '
+              f'({(elapsed - plain) / items * 1e9:+,.0f}ns vs plain)')
+    print('whole pool per task (plain runs the worker without the telemetry branch):')
+    plain, _ = _bench_pool(workers, items, 'plain')
+    for mode in modes:
+        elapsed, stats = (plain, {}) if mode == 'plain' else _bench_pool(workers, items, mode)
+        print(f'{mode:>9}: {elapsed / items * 1e9:,.0f}ns per task '
+              f'({(elapsed - plain) / items * 1e9:+,.0f}ns vs plain)')
+        for task_name, task_stats in stats.items():
+            print(f'{task_name}: queue wait {task_stats["queue_wait"]}')
+            print(f'{task_name}: run time {task_stats["run_time"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ThreadPoolExecutor benchmarks')
+    parser.add_argument('bench', choices=['stealing', 'map', 'scaling', 'telemetry'], help='benchmark to run')
+    parser.add_argument('-workers', '--workers', type=int, default=8, help='number of worker threads')
+    parser.add_argument('-roots', '--roots', type=int, default=200, help='number of fan-out tasks')
+    parser.add_argument('-width', '--width', type=int, default=500, help='children per fan-out task')
+    parser.add_argument('-items', '--items', type=int, default=200000, help='number of items to map')
+    parser.add_argument('-chunksize', '--chunksize', type=int, default=256, help='items per work item')
+    parser.add_argument('-bursts', '--bursts', type=int, default=10, help='number of traffic bursts')
+    parser.add_argument('-burst_size', '--burst_size', type=int, default=100, help='tasks per burst')
+    parser.add_argument('-pause', '--pause', type=float, default=0.5, help='seconds between bursts')
+    arguments = parser.parse_args()
+    if arguments.bench == 'stealing':
+        bench_work_stealing(arguments.workers, arguments.roots, arguments.width)
+    elif arguments.bench == 'map':
+        bench_map(arguments.workers, arguments.items, arguments.chunksize)
+    elif arguments.bench == 'scaling':
+        bench_scaling(arguments.workers, arguments.bursts, arguments.burst_size, arguments.pause)
+    elif arguments.bench == 'telemetry':
+        bench_telemetry(arguments.workers, arguments.items)
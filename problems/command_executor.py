@@ -0,0 +1,373 @@
+import os
+import sys
+import pickle
+import socket
+import selectors
+from collections import deque
+from contextlib import suppress
+from itertools import count
+from threading import Thread, RLock
+from time import monotonic as time
+import popen
+from future import Future, InvalidStateError
+from popen import Popen, TimeoutExpired, _Output
+from thread_pool import ExecutorShutdown
+from process_pool import WorkerCrashed
+
+
+# Requests and replies are single SOCK_SEQPACKET records carrying a pickled
+# tuple, spawn requests pass the child's stdin, stdout and stderr along as
+# SCM_RIGHTS ancillary data.
+_MAX_MESSAGE = 256 * 1024
+_SPAWN = 'spawn'
+_KILL = 'kill'
+_EXITED = 'exited'
+
+
+def _send_message(sock, message, fds=()):
+    socket.send_fds(sock, [pickle.dumps(message, pickle.HIGHEST_PROTOCOL)], fds)
+
+
+def _receive_message(sock):
+    """Return (message, fds), message is None once the other side closed the socket."""
+    data, fds, _, _ = socket.recv_fds(sock, _MAX_MESSAGE, 3)
+    if not data:
+        return None, fds
+    return pickle.loads(data), fds
+
+
+def _helper(sock):
+    """Main loop of the helper process: spawn children on request and report their exit."""
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    processes = {}
+    home = os.open('.', os.O_RDONLY)
+    while True:
+        for key, _ in selector.select():
+            if key.data is not None:
+                command_id, pidfd = key.data
+                selector.unregister(pidfd)
+                os.close(pidfd)
+                returncode = processes.pop(command_id).wait()
+                _send_message(sock, (_EXITED, command_id, returncode, None))
+                continue
+            message, fds = _receive_message(sock)
+            if message is None:
+                for process in processes.values():
+                    process.kill()
+                return
+            if message[0] == _KILL:
+                with suppress(KeyError, ProcessLookupError):
+                    processes[message[1]].kill()
+                continue
+            _, command_id, args, cwd = message
+            stdin, stdout, stderr = fds
+            try:
+                # The helper is single threaded, so it can step into cwd itself
+                # and let Popen use posix_spawnp instead of forking for the chdir.
+                if cwd is not None:
+                    os.chdir(cwd)
+            except OSError as e:
+                for fd in fds:
+                    os.close(fd)
+                _send_message(sock, (_EXITED, command_id, None, e))
+                continue
+            try:
+                # Popen closes the descriptors it is given once the child started.
+                process = Popen(args, stdin=stdin, stdout=stdout, stderr=stderr).__enter__()
+            except Exception as e:
+                _send_message(sock, (_EXITED, command_id, None, e))
+                continue
+            finally:
+                if cwd is not None:
+                    os.fchdir(home)
+            processes[command_id] = process
+            pidfd = os.pidfd_open(process._child_process_id)
+            selector.register(pidfd, selectors.EVENT_READ, (command_id, pidfd))
+
+
+class CompletedCommand:
+    """Result of a command run by CommandExecutor."""
+
+    def __init__(self, args, returncode, stdout, stderr):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return (f'CompletedCommand(args={self.args!r}, returncode={self.returncode}, '
+                f'stdout={self.stdout!r}, stderr={self.stderr!r})')
+
+
+class _Command:
+
+    def __init__(self, command_id, future, args, input_to_send, timeout, cwd):
+        self.id = command_id
+        self.future = future
+        self.args = args
+        self.input = input_to_send
+        self.timeout = timeout
+        self.cwd = cwd
+        self.deadline = None
+        self.process = None
+        self.pidfd = None
+        self.streams = []
+        self.outputs = {}
+        self.returncode = None
+        self.exited = False
+        self.timed_out = False
+
+
+class CommandExecutor:
+    """Runs commands and returns Futures of CompletedCommand.
+
+    Commands that popen starts with posix_spawnp are spawned right here,
+    that does not copy this process. Those with a cwd would need a fork of
+    this process and go to a warm helper instead: a fresh single threaded
+    interpreter started once, which changes into cwd around posix_spawnp. At most
+    max_concurrency commands run at a time, the rest wait in submission
+    order. A command running longer than its timeout is killed and its
+    future fails with popen.TimeoutExpired; cancelling the future of a
+    running command kills it as well.
+    """
+
+    def __init__(self, max_concurrency=None):
+
+        if max_concurrency is None:
+            max_concurrency = 4 * (os.cpu_count() or 1)
+
+        if max_concurrency <= 0:
+            raise ValueError('max_concurrency must be greater than 0')
+
+        self._max_concurrency = max_concurrency
+        self._ids = count()
+        self._pending = deque()
+        self._running = {}
+        self._kills = deque()
+        self._shutdown = False
+        self._shutdown_lock = RLock()
+        self._sock, helper_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._helper_process = Popen([sys.executable, __file__], stdin=helper_sock.detach()).__enter__()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+        self._manager = Thread(target=self._manage, daemon=True)
+        self._manager.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown(wait=True)
+
+    def _wakeup(self):
+        with suppress(BlockingIOError):
+            os.write(self._wakeup_write, b'\0')
+
+    def _request_kill(self, command, future):
+        if future.canceled():
+            self._kills.append(command)
+            self._wakeup()
+
+    def _stdin_for(self, command):
+        if not command.input:
+            return os.open(os.devnull, os.O_RDONLY)
+        # A memfd holds the whole input, so nobody has to feed a pipe.
+        fd = os.memfd_create('command-input', os.MFD_CLOEXEC)
+        try:
+            os.write(fd, command.input)
+            os.lseek(fd, 0, os.SEEK_SET)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _dispatch(self, selector):
+        while self._pending and len(self._running) < self._max_concurrency:
+            command = self._pending.popleft()
+            if command.future.done():
+                continue
+            opened = []
+            try:
+                stdin = self._stdin_for(command)
+                opened.append(stdin)
+                out_read, out_write = os.pipe()
+                opened.extend((out_read, out_write))
+                err_read, err_write = os.pipe()
+                opened.extend((err_read, err_write))
+                if popen._USE_POSIX_SPAWN and command.cwd is None:
+                    self._spawn(command, stdin, out_write, err_write, opened)
+                else:
+                    _send_message(self._sock, (_SPAWN, command.id, command.args, command.cwd),
+                                  [stdin, out_write, err_write])
+            except Exception as e:
+                for fd in opened:
+                    os.close(fd)
+                with suppress(InvalidStateError):
+                    command.future.set_exception(e)
+                continue
+            if command.process is None:
+                for fd in (stdin, out_write, err_write):
+                    os.close(fd)
+            else:
+                selector.register(command.pidfd, selectors.EVENT_READ, command)
+            for fd in (out_read, err_read):
+                stream = open(fd, 'rb', 0)
+                command.streams.append(stream)
+                command.outputs[stream] = _Output()
+                selector.register(stream, selectors.EVENT_READ, command)
+            if command.timeout is not None:
+                command.deadline = time() + command.timeout
+            self._running[command.id] = command
+
+    @staticmethod
+    def _spawn(command, stdin, stdout, stderr, opened):
+        # Popen closes the descriptors it is given once the child started or failed to.
+        for fd in (stdin, stdout, stderr):
+            opened.remove(fd)
+        command.process = Popen(command.args, stdin=stdin, stdout=stdout, stderr=stderr).__enter__()
+        try:
+            command.pidfd = os.pidfd_open(command.process._child_process_id)
+        except BaseException:
+            command.process.kill()
+            command.process.wait()
+            raise
+
+    def _reap(self, command, selector):
+        selector.unregister(command.pidfd)
+        os.close(command.pidfd)
+        command.returncode = command.process.wait()
+        command.exited = True
+        self._finish(command)
+
+    def _kill(self, command):
+        if command.id in self._running and not command.exited:
+            if command.process is not None:
+                command.process.kill()
+            else:
+                _send_message(self._sock, (_KILL, command.id))
+
+    def _expire(self):
+        """Kill commands past their deadline, return the seconds until the next deadline."""
+        now = time()
+        remaining = None
+        for command in self._running.values():
+            if command.deadline is None or command.timed_out or command.exited:
+                continue
+            if command.deadline <= now:
+                command.timed_out = True
+                self._kill(command)
+            elif remaining is None or command.deadline - now < remaining:
+                remaining = command.deadline - now
+        return remaining
+
+    def _finish(self, command):
+        if not command.exited or not all(stream.closed for stream in command.streams):
+            return
+        del self._running[command.id]
+        future = command.future
+        with suppress(InvalidStateError):
+            if command.timed_out:
+                future.set_exception(TimeoutExpired(f'{command.args!r} did not finish within '
+                                                    f'{command.timeout} seconds'))
+            elif command.returncode is not None:
+                stdout, stderr = (command.outputs[stream].getvalue() for stream in command.streams)
+                future.set_result(CompletedCommand(command.args, command.returncode, stdout, stderr))
+
+    def _read_output(self, stream, command, selector):
+        if command.outputs[stream].read_from(stream):
+            return
+        selector.unregister(stream)
+        stream.close()
+        self._finish(command)
+
+    def _receive_exit(self):
+        message, _ = _receive_message(self._sock)
+        if message is None:
+            raise WorkerCrashed(f'command helper {self._helper_process._child_process_id} exited')
+        _, command_id, returncode, exception = message
+        command = self._running[command_id]
+        command.exited = True
+        command.returncode = returncode
+        if exception is not None:
+            with suppress(InvalidStateError):
+                command.future.set_exception(exception)
+        self._finish(command)
+
+    def _fail_all(self, exception):
+        with self._shutdown_lock:
+            self._shutdown = True
+            commands = list(self._pending) + list(self._running.values())
+            self._pending.clear()
+            self._running.clear()
+        for command in commands:
+            if command.process is not None and not command.exited:
+                command.process.kill()
+                command.process.wait()
+                os.close(command.pidfd)
+            for stream in command.streams:
+                stream.close()
+            with suppress(InvalidStateError):
+                command.future.set_exception(exception)
+
+    def _manage(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_read, selectors.EVENT_READ)
+        selector.register(self._sock, selectors.EVENT_READ)
+        while True:
+            with self._shutdown_lock:
+                self._dispatch(selector)
+                if self._shutdown and not self._pending and not self._running:
+                    break
+            while self._kills:
+                self._kill(self._kills.popleft())
+            for key, _ in selector.select(self._expire()):
+                if key.fileobj == self._wakeup_read:
+                    with suppress(BlockingIOError):
+                        os.read(self._wakeup_read, 4096)
+                elif key.fileobj is self._sock:
+                    try:
+                        self._receive_exit()
+                    except WorkerCrashed as e:
+                        self._fail_all(e)
+                        selector.unregister(self._sock)
+                        break
+                elif key.fileobj == key.data.pidfd:
+                    self._reap(key.data, selector)
+                else:
+                    self._read_output(key.fileobj, key.data, selector)
+        selector.close()
+        self._sock.close()
+        self._helper_process.wait()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def submit(self, args, input_to_send=None, timeout=None, cwd=None):
+        """Run the command args and return a Future of its CompletedCommand.
+
+        stdout and stderr are captured, stdin reads input_to_send or is empty.
+        input_to_send must be bytes-like, anything else raises TypeError here.
+        A non-zero returncode is not an error, check CompletedCommand.returncode.
+        """
+        if input_to_send is not None:
+            input_to_send = memoryview(input_to_send).cast('B')
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise ExecutorShutdown()
+            future_result = Future()
+            command = _Command(next(self._ids), future_result, args, input_to_send, timeout, cwd)
+            future_result.add_done_callback(lambda future: self._request_kill(command, future))
+            self._pending.append(command)
+            self._wakeup()
+            return future_result
+
+    def shutdown(self, wait=False):
+        with self._shutdown_lock:
+            self._shutdown = True
+            self._wakeup()
+        if wait:
+            self._manager.join()
+
+
+if __name__ == '__main__':
+    _helper(socket.socket(fileno=0))
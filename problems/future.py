@@ -1,4 +1,8 @@
-from threading import Condition, RLock
+from threading import Condition, Lock, Thread
+from contextlib import suppress
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
 from time import monotonic as time
 
 
@@ -7,6 +11,10 @@ RUNNING = 1
 CANCELLED = 2
 FINISHED = 3
 
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
 
 class InvalidStateError(Exception):
     """The operation is not allowed in this state."""
@@ -16,128 +24,411 @@ class CancelledError(InvalidStateError):
     """The Future was cancelled."""
 
 
+# Futures share a fixed set of locks picked by object id instead of each
+# allocating its own. The lock only guards state transitions, the condition
+# built on it is created by the first thread that actually has to block.
+_LOCK_STRIPES = 64
+_locks = [Lock() for _ in range(_LOCK_STRIPES)]
+
+
 class Future:
 
+    __slots__ = ('_lock', '_done_condition', '_state', '_result', '_exception', '_done_callbacks')
+
     def __init__(self):
-        self._done_condition = Condition(RLock())
+        self._lock = _locks[(id(self) >> 4) % _LOCK_STRIPES]
+        self._done_condition = None
         self._state = PENDING
         self._result = None
         self._exception = None
-        self._done_callbacks = []
+        self._done_callbacks = None
 
     def __invoke_callbacks(self):
+        # No callback can be added once the state is final, so the list is
+        # safe to walk without the lock.
+        if self._done_callbacks is None:
+            return
         for callback in self._done_callbacks:
             try:
                 callback(self)
             except Exception:
                 print('exception calling callback')
 
-    def __get_result(self):
-        if self._exception:
-            raise self._exception
-        return self._result
-
     def __result(self):
         if self._state == CANCELLED:
             raise CancelledError()
-        if self._state == FINISHED:
-            return self.__get_result()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def __wait(self, timeout):
+        with self._lock:
+            if self._state >= CANCELLED:
+                return
+            if self._done_condition is None:
+                self._done_condition = Condition(self._lock)
+            if not self._done_condition.wait_for(self.__is_done, timeout):
+                raise TimeoutError()
+
+    def __is_done(self):
+        return self._state >= CANCELLED
+
+    def __finish(self, state):
+        """Switch to a final state; the caller holds the lock."""
+        self._state = state
+        if self._done_condition is not None:
+            self._done_condition.notify_all()
 
     def result(self, timeout=None):
         """The result method gives us any returned values from the future object."""
-        start_time = time()
-        with self._done_condition:
-            res = self.__result()
-            if res:
-                return res
-            self._done_condition.wait(timeout)
-            if timeout and start_time + timeout < time():
-                raise TimeoutError()
-            return self.__result()
+        if self._state < CANCELLED:
+            self.__wait(timeout)
+        return self.__result()
 
     def set_result(self, result):
         """Sets the return value of work associated with the future."""
-        with self._done_condition:
-            if self._state in [CANCELLED, FINISHED]:
+        with self._lock:
+            if self._state >= CANCELLED:
                 raise InvalidStateError()
             self._result = result
-            self._state = FINISHED
-            self._done_condition.notify_all()
+            self.__finish(FINISHED)
         self.__invoke_callbacks()
 
     def add_done_callback(self, callback):
         """The add_done_callback allows to specify a callback function which
         will be executed at the point of the future's completion."""
-        with self._done_condition:
-            if self._state in [PENDING, RUNNING]:
-                self._done_callbacks.append(callback)
-                return
+        if self._state < CANCELLED:
+            with self._lock:
+                if self._state < CANCELLED:
+                    if self._done_callbacks is None:
+                        self._done_callbacks = [callback]
+                    else:
+                        self._done_callbacks.append(callback)
+                    return
         try:
             callback(self)
         except Exception:
             print('exception calling callback')
 
+    def remove_done_callback(self, callback):
+        """Remove every registration of callback; returns the number removed."""
+        if self._done_callbacks is None:
+            return 0
+        with self._lock:
+            if self._state >= CANCELLED or self._done_callbacks is None:
+                return 0
+            remaining = [registered for registered in self._done_callbacks if registered is not callback]
+            removed = len(self._done_callbacks) - len(remaining)
+            self._done_callbacks = remaining or None
+            return removed
+
     def running(self):
         """Return True if the future is currently executing."""
-        with self._done_condition:
-            return self._state == RUNNING
+        return self._state == RUNNING
 
     def done(self):
         """Return True of the future was cancelled or finished executing"""
-        with self._done_condition:
-            return self._state in [CANCELLED, FINISHED]
+        return self._state >= CANCELLED
 
     def cancel(self):
         """Cancel the future if possible.
         Returns True if the future was cancelled, False otherwise. A future
         cannot be cancelled if it is running or has already completed.
         """
-        with self._done_condition:
+        with self._lock:
             if self._state in [RUNNING, FINISHED]:
                 return False
             if self._state == CANCELLED:
                 return True
-            self._state = CANCELLED
-            self._done_condition.notify_all()
+            self.__finish(CANCELLED)
         self.__invoke_callbacks()
         return True
 
     def canceled(self):
         """Return True if the future was cancelled."""
-        with self._done_condition:
-            return self._state == CANCELLED
-
-    def __exception(self):
-        if self._state == CANCELLED:
-            raise CancelledError()
-        if self._state == FINISHED:
-            return self._exception
+        return self._state == CANCELLED
 
     def exception(self, timeout=None):
         """Return the exception raised by the call that the future represents."""
-        start_time = time()
-        with self._done_condition:
-            res = self.__exception()
-            if res:
-                return res
-            self._done_condition.wait(timeout)
-            if timeout and start_time + timeout < time():
-                raise TimeoutError()
-            return self.__exception()
+        if self._state < CANCELLED:
+            self.__wait(timeout)
+        if self._state == CANCELLED:
+            raise CancelledError()
+        return self._exception
 
     def set_exception(self, exception):
         """Sets the result of the future as being the given exception."""
-        with self._done_condition:
-            if self._state in [CANCELLED, FINISHED]:
+        with self._lock:
+            if self._state >= CANCELLED:
                 raise InvalidStateError()
             self._exception = exception
-            self._state = FINISHED
-            self._done_condition.notify_all()
+            self.__finish(FINISHED)
+        self.__invoke_callbacks()
 
     def set_running(self):
         """Mark the future as running or process any cancel notifications."""
-        with self._done_condition:
+        with self._lock:
             if self._state == PENDING:
                 self._state = RUNNING
                 return True
             return False
+
+    def __await__(self):
+        """Await the future from a coroutine without blocking a thread."""
+        return wrap_future(self).__await__()
+
+    def then(self, fn, executor=None):
+        """Return a future for fn(result) that is scheduled once this one finishes.
+
+        fn runs in the thread that completes this future, or is submitted to
+        executor if one is given. If fn returns a Future, the returned future
+        follows it. Exceptions and cancellation skip fn and pass through.
+        """
+        chained = Future()
+        self.add_done_callback(partial(_run_then, fn, executor, chained))
+        return chained
+
+
+def _copy_state(source, destination):
+    if destination.cancelled():
+        return
+    if source.canceled():
+        destination.cancel()
+    elif (exception := source.exception()) is not None:
+        destination.set_exception(exception)
+    else:
+        destination.set_result(source.result())
+
+
+def wrap_future(future, *, loop=None):
+    """Return an asyncio future that completes together with future.
+
+    Completion is handed over to the event loop with call_soon_threadsafe,
+    so no thread waits on future. Cancelling the asyncio future cancels
+    future if it has not started yet.
+    """
+    import asyncio
+
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    async_future = loop.create_future()
+
+    def on_done(source):
+        with suppress(RuntimeError):
+            loop.call_soon_threadsafe(_copy_state, source, async_future)
+
+    def on_async_done(destination):
+        if destination.cancelled():
+            future.cancel()
+
+    async_future.add_done_callback(on_async_done)
+    future.add_done_callback(on_done)
+    return async_future
+
+
+def _transfer(source, destination):
+    """Copy the outcome of a done source future unless destination is already done."""
+    with suppress(InvalidStateError):
+        if source.canceled():
+            destination.cancel()
+        elif (exception := source.exception()) is not None:
+            destination.set_exception(exception)
+        else:
+            _resolve(destination, source.result())
+
+
+def _resolve(destination, value):
+    if isinstance(value, Future):
+        value.add_done_callback(partial(_transfer, destination=destination))
+    else:
+        with suppress(InvalidStateError):
+            destination.set_result(value)
+
+
+def _run_then(fn, executor, chained, source):
+    if source.canceled() or source.exception() is not None:
+        _transfer(source, chained)
+        return
+    try:
+        if executor is None:
+            value = fn(source.result())
+        else:
+            value = executor.submit(fn, source.result())
+    except Exception as e:
+        with suppress(InvalidStateError):
+            chained.set_exception(e)
+    else:
+        _resolve(chained, value)
+
+
+class _Timer:
+    """One daemon thread running the callbacks of every pending with_timeout."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = count()
+        self._condition = Condition(Lock())
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        entry = [time() + delay, next(self._counter), callback]
+        with self._condition:
+            heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                remaining = self._heap[0][0] - time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                _, _, callback = heappop(self._heap)
+            if callback is not None:
+                try:
+                    callback()
+                except Exception:
+                    print('exception calling timer callback')
+
+
+_timer = _Timer()
+
+
+def _expire(source, timed):
+    with suppress(InvalidStateError):
+        timed.set_exception(TimeoutError())
+    source.cancel()
+
+
+def _finish_before_timeout(timed, entry, source):
+    _Timer.cancel(entry)
+    _transfer(source, timed)
+
+
+def with_timeout(future, seconds):
+    """Return a future that follows future, or fails with TimeoutError after seconds.
+
+    On timeout future is cancelled if it has not started running yet.
+    """
+    timed = Future()
+    entry = _timer.schedule(seconds, partial(_expire, future, timed))
+    future.add_done_callback(partial(_finish_before_timeout, timed, entry))
+    return timed
+
+
+def gather(*futures):
+    """Return a future for the list of results of futures, in the same order.
+
+    It fails with the first exception, or is cancelled with the first
+    cancellation, among futures.
+    """
+    gathered = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def on_done(index, future):
+        if future.canceled() or future.exception() is not None:
+            _transfer(future, gathered)
+            return
+        results[index] = future.result()
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        with suppress(InvalidStateError):
+            gathered.set_result(results)
+
+    if not futures:
+        gathered.set_result(results)
+    for index, future in enumerate(futures):
+        future.add_done_callback(partial(on_done, index))
+    return gathered
+
+
+class _Waiter:
+    """Done callback shared by all futures of one wait or as_completed call.
+
+    Every future reports itself once, so waiting on n futures costs O(n)
+    in total no matter how many times the waiting thread wakes up.
+    """
+
+    def __init__(self, count, return_when=FIRST_COMPLETED):
+        self.condition = Condition(Lock())
+        self.finished = []
+        self._remaining = count
+        self._return_when = return_when
+        self.should_return = count == 0
+
+    def __call__(self, future):
+        with self.condition:
+            self.finished.append(future)
+            self._remaining -= 1
+            if (self._return_when == FIRST_COMPLETED or not self._remaining or
+                    self._return_when == FIRST_EXCEPTION and _has_exception(future)):
+                self.should_return = True
+                self.condition.notify()
+
+
+def _has_exception(future):
+    return not future.canceled() and future.exception() is not None
+
+
+def as_completed(futures, timeout=None):
+    """Yield the given futures as they complete, finished or cancelled.
+
+    Raises TimeoutError if some futures are still pending after timeout seconds.
+    """
+    if timeout is not None:
+        end_time = time() + timeout
+    futures = set(futures)
+    waiter = _Waiter(len(futures))
+    for future in futures:
+        future.add_done_callback(waiter)
+    remaining = len(futures)
+    try:
+        while remaining:
+            with waiter.condition:
+                if timeout is None:
+                    waiter.condition.wait_for(lambda: waiter.finished)
+                elif not waiter.condition.wait_for(lambda: waiter.finished, end_time - time()):
+                    raise TimeoutError(f'{remaining} of {len(futures)} futures unfinished')
+                finished, waiter.finished = waiter.finished, []
+            remaining -= len(finished)
+            yield from finished
+    finally:
+        # A timed out or abandoned call must not leave its waiter on pending futures.
+        for future in futures:
+            future.remove_done_callback(waiter)
+
+
+def wait(futures, timeout=None, return_when=ALL_COMPLETED):
+    """Wait for the futures to complete and return a (done, not_done) pair of sets.
+
+    return_when is FIRST_COMPLETED, FIRST_EXCEPTION or ALL_COMPLETED.
+    Returns early, without raising, if timeout seconds pass first.
+    """
+    if return_when not in [FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED]:
+        raise ValueError(f'unknown return_when {return_when!r}')
+    futures = set(futures)
+    waiter = _Waiter(len(futures), return_when)
+    for future in futures:
+        future.add_done_callback(waiter)
+    try:
+        with waiter.condition:
+            waiter.condition.wait_for(lambda: waiter.should_return, timeout)
+            done = set(waiter.finished)
+    finally:
+        for future in futures:
+            future.remove_done_callback(waiter)
+    return done, futures - done
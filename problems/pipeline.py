@@ -0,0 +1,151 @@
+import os
+import io
+from threading import Thread
+from popen import Popen
+
+
+_SPLICE_SIZE = 1 << 20
+
+
+def _child_end(value):
+    """Duplicate a caller's descriptor, Popen closes the ones it is given once the child started."""
+    if value is None or value in (Popen.PIPE, Popen.STDOUT, Popen.DEVNULL):
+        return value
+    return os.dup(value if isinstance(value, int) else value.fileno())
+
+
+def _tap(read_end, tap, write_end):
+    """Move everything arriving on the pipe read_end into the regular file tap, then on to write_end.
+
+    splice moves pipe pages into the file and sendfile sends them from the
+    page cache into the write_end pipe, so the data never enters Python.
+    write_end may be None, and a closed reader on it only stops forwarding.
+    """
+    position = os.lseek(tap, 0, os.SEEK_CUR)
+    try:
+        while count := os.splice(read_end, tap, _SPLICE_SIZE, offset_dst=position):
+            offset = position
+            position += count
+            while write_end is not None and offset < position:
+                try:
+                    offset += os.sendfile(write_end, tap, offset, position - offset)
+                except BrokenPipeError:
+                    os.close(write_end)
+                    write_end = None
+    finally:
+        os.lseek(tap, position, os.SEEK_SET)
+        os.close(read_end)
+        if write_end is not None:
+            os.close(write_end)
+
+
+class Pipeline:
+    """Runs commands with each one's stdout connected to the next one's stdin, like a | b | c.
+
+    The stages are wired with os.pipe directly, no shell is involved and
+    the data does not pass through this process. stdin applies to the first
+    stage, stdout to the last one and stderr to all of them, with the same
+    values Popen accepts; with PIPE the ends are available as stdin and
+    stdout. taps maps a stage index to a regular file, given as descriptor
+    or file object, that receives a copy of the stage's output.
+    """
+
+    def __init__(self, commands, *, stdin=None, stdout=None, stderr=None, cwd=None, taps=None):
+        if not commands:
+            raise ValueError('a pipeline needs at least one command')
+        self._commands = commands
+        self._stdin = stdin
+        self._stdout = stdout
+        self._stderr = stderr
+        self._cwd = cwd
+        self._taps = taps or {}
+        self._tap_threads = []
+        self.processes = []
+        self.stdin = None
+        self.stdout = None
+        self.returncodes = None
+
+    def __enter__(self):
+        self._start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wait()
+
+    def _tap_target(self, index):
+        """Return the descriptor the tap of stage index forwards to, None to forward nowhere."""
+        if index < len(self._commands) - 1:
+            read_end, write_end = os.pipe()
+            return read_end, write_end
+        if self._stdout == Popen.PIPE:
+            read_end, write_end = os.pipe()
+            self.stdout = io.open(read_end, 'rb', 0)
+            return None, write_end
+        if self._stdout == Popen.DEVNULL:
+            return None, None
+        return None, os.dup(1) if self._stdout is None else _child_end(self._stdout)
+
+    def _start(self):
+        source = _child_end(self._stdin)
+        last = len(self._commands) - 1
+        for index, args in enumerate(self._commands):
+            tap = self._taps.get(index)
+            if index == last and tap is None:
+                read_end, destination = None, _child_end(self._stdout)
+            else:
+                read_end, destination = os.pipe()
+            try:
+                # Popen closes source, destination and stderr even if it fails.
+                process = Popen(args, stdin=source, stdout=destination, stderr=_child_end(self._stderr),
+                                cwd=self._cwd).__enter__()
+            except BaseException:
+                if read_end is not None:
+                    os.close(read_end)
+                self._abort()
+                raise
+            self.processes.append(process)
+            if tap is not None:
+                source, write_end = self._tap_target(index)
+                tap_fd = tap if isinstance(tap, int) else tap.fileno()
+                thread = Thread(target=_tap, args=(read_end, tap_fd, write_end), daemon=True)
+                thread.start()
+                self._tap_threads.append(thread)
+            else:
+                source = read_end
+        self.stdin = self.processes[0].inwrite
+        if self.stdout is None:
+            self.stdout = self.processes[-1].outread
+
+    def _abort(self):
+        """Kill and reap the stages already started when a later one could not be."""
+        for process in self.processes:
+            process.kill()
+            for stream in (process.inwrite, process.outread, process.erread):
+                if stream is not None:
+                    stream.close()
+        for process in self.processes:
+            process.wait()
+        if self.stdout is not None:
+            self.stdout.close()
+        for thread in self._tap_threads:
+            thread.join()
+
+    def poll(self):
+        """Return the list of returncodes once every stage exited, None before."""
+        if any(process.poll() is None for process in self.processes):
+            return None
+        return self.wait()
+
+    def wait(self):
+        """Wait for every stage to exit; returns the list of their returncodes in stage order."""
+        if self.returncodes is None:
+            returncodes = [process.wait() for process in self.processes]
+            for thread in self._tap_threads:
+                thread.join()
+            self.returncodes = returncodes
+        return self.returncodes
+
+    @property
+    def returncode(self):
+        """The returncode of the last stage, like a shell reports it; None while running."""
+        return None if self.returncodes is None else self.returncodes[-1]
@@ -3,7 +3,56 @@ import os
 import sys
 import io
 import select
+import selectors
+from collections import deque
 from contextlib import suppress
+from threading import Thread, Condition
+from time import monotonic as time
+
+
+# Outputs are read straight into preallocated chunks that double in size up
+# to _MAX_OUTPUT_CHUNK, so growing never copies what was already read. Input
+# is written in pieces of at most _WRITE_CHUNK bytes to a non-blocking pipe.
+_INITIAL_OUTPUT_CHUNK = 64 * 1024
+_MAX_OUTPUT_CHUNK = 16 * 2 ** 20
+_WRITE_CHUNK = 64 * 1024
+
+# Defaults of iter_chunks and iter_lines; a longer line is yielded in pieces.
+_ITER_CHUNK = 64 * 1024
+_MAX_BUFFERED_CHUNKS = 64
+_MAX_LINE_LENGTH = 1024 * 1024
+
+# Children that need no Python code run between fork and exec are started
+# with posix_spawnp instead of fork when the platform has it.
+_USE_POSIX_SPAWN = hasattr(os, 'posix_spawnp')
+
+
+class TimeoutExpired(Exception):
+    """Throws when the child did not finish communicating within the timeout"""
+
+
+class _Output:
+    """Chunked buffer a pipe is read into with readinto, no intermediate bytes objects."""
+
+    __slots__ = ('chunks', 'view', 'used')
+
+    def __init__(self):
+        self.chunks = []
+        self.view = memoryview(bytearray(_INITIAL_OUTPUT_CHUNK))
+        self.used = 0
+
+    def read_from(self, stream):
+        """Read whatever the pipe holds, returns False at end of file."""
+        if self.used == len(self.view):
+            self.chunks.append(self.view)
+            self.view = memoryview(bytearray(min(2 * len(self.view), _MAX_OUTPUT_CHUNK)))
+            self.used = 0
+        count = stream.readinto(self.view[self.used:])
+        self.used += count
+        return count > 0
+
+    def getvalue(self):
+        return b''.join([*self.chunks, self.view[:self.used]])
 
 
 class Popen:
@@ -21,12 +70,13 @@ class Popen:
         self._stderr = stderr
         self._shell = shell
         self._cwd = cwd
-        self._devnull = os.open(os.devnull, os.O_RDWR)
         self._child_process_id = None
         self.returncode = None
         self.inwrite = None
         self.outread = None
         self.erread = None
+        self._input = None
+        self._outputs = None
 
     def _get_handler(self, prop, index):
         handlers = [-1, -1]
@@ -34,7 +84,8 @@ class Popen:
             if prop == Popen.PIPE:
                 handlers = os.pipe()
             elif prop == Popen.DEVNULL:
-                handlers[index] = self._devnull
+                # Closed again with the other child ends once the child started.
+                handlers[index] = os.open(os.devnull, os.O_RDWR)
             elif isinstance(prop, int) and prop >= 0:
                 handlers[index] = prop
             elif hasattr(prop, 'fileno'):
@@ -57,38 +108,61 @@ class Popen:
             errread, errwrite
         )
     
-    def _start_child(self):
-        (inread, inwrite, outread, outwrite, errread, errwrite) = self._get_handlers()
-        parent_fds = [inwrite, outread, errread]
-        child_fds = [inread, outwrite, errwrite]
+    def _fork_child(self, args, parent_fds, child_fds):
         pid = os.fork()
         if pid == 0:
+            try:
+                for fd_to_close in parent_fds:
+                    if fd_to_close != -1:
+                        os.close(fd_to_close)
+                for stdfd, potfd in enumerate(child_fds):
+                    if potfd != -1:
+                        os.dup2(potfd, stdfd)
+                if self._cwd is not None:
+                    os.chdir(self._cwd)
+                os.execvpe(args[0], args, os.environ.copy())
+            finally:
+                os._exit(127)
+        return pid
+
+    @staticmethod
+    def _spawn_child(args, parent_fds, child_fds):
+        """Start the child with posix_spawnp, which glibc implements with vfork.
+
+        Unlike fork it does not copy the page tables of our address space,
+        so its cost does not grow with the parent's memory. The pipe ends are
+        non-inheritable, so only the dup2 actions are needed.
+        """
+        file_actions = [(os.POSIX_SPAWN_DUP2, potfd, stdfd)
+                        for stdfd, potfd in enumerate(child_fds) if potfd != -1]
+        try:
+            return os.posix_spawnp(args[0], args, os.environ, file_actions=file_actions)
+        except OSError:
             for fd_to_close in parent_fds:
                 if fd_to_close != -1:
                     os.close(fd_to_close)
-            for stdfd, potfd in enumerate(child_fds):
-                if potfd != -1:
-                    os.dup2(potfd, stdfd)
-            if self._shell:
-                self._args = self._args.split(' ')
-            os.execvpe(self._args[0], self._args, os.environ.copy()) 
-        else:
+            raise
+
+    def _start_child(self):
+        (inread, inwrite, outread, outwrite, errread, errwrite) = self._get_handlers()
+        parent_fds = [inwrite, outread, errread]
+        child_fds = [inread, outwrite, errwrite]
+        args = self._args.split(' ') if self._shell else self._args
+        try:
+            # Setup that has to run as Python code in the child needs fork.
+            if _USE_POSIX_SPAWN and self._cwd is None:
+                pid = self._spawn_child(args, parent_fds, child_fds)
+            else:
+                pid = self._fork_child(args, parent_fds, child_fds)
+        finally:
             for fd_to_close in child_fds:
                 if fd_to_close != -1:
                     with suppress(IOError):
                         os.close(fd_to_close)
-            for fd, prop, flag in zip(parent_fds, ['inwrite', 'outread', 'erread'], ['wb', 'rb', 'rb']):
-                if fd != -1:
-                    setattr(self, prop, io.open(fd, flag, 0))
-            return pid
-    
-    @staticmethod
-    def _read_result(read_stream):
-        result = b''
-        while (chunk := read_stream.read(select.PIPE_BUF)) != b'':
-            result += chunk
-        read_stream.close()
-        return result
+        for fd, prop, flag in zip(parent_fds, ['inwrite', 'outread', 'erread'], ['wb', 'rb', 'rb']):
+            if fd != -1:
+                setattr(self, prop, io.open(fd, flag, 0))
+        return pid
 
     def __enter__(self):
         self._child_process_id = self._start_child()
@@ -97,28 +171,181 @@ class Popen:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.wait()
 
-    def communicate(self, input_to_send=None):
-        stdout = stderr = None
-        if input_to_send and self.inwrite:
-            self.inwrite.write(input_to_send)
+    def _start_communication(self, input_to_send):
+        self._outputs = {stream: _Output() for stream in (self.outread, self.erread) if stream}
+        if self.inwrite:
+            if input_to_send:
+                self._input = memoryview(input_to_send).cast('B')
+                os.set_blocking(self.inwrite.fileno(), False)
+            else:
+                self.inwrite.close()
+
+    def _write_input(self, selector):
+        try:
+            written = os.write(self.inwrite.fileno(), self._input[:_WRITE_CHUNK])
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            # The child does not want the rest of the input.
+            written = len(self._input)
+        self._input = self._input[written:]
+        if not self._input:
+            selector.unregister(self.inwrite)
             self.inwrite.close()
-        if self.outread:
-            stdout = Popen._read_result(self.outread)
-        if self.erread:
-            stderr = Popen._read_result(self.erread)
-        self.wait()
+
+    def communicate(self, input_to_send=None, timeout=None):
+        """Send input_to_send to stdin, read stdout and stderr to end of file, then wait for the child.
+
+        All pipes are served at once by a single selector loop, so a child
+        blocked on a full stderr pipe can not deadlock us while we wait for
+        its stdout. Raises TimeoutExpired if that takes more than timeout
+        seconds; calling communicate again continues where it stopped.
+        """
+        if self._outputs is None:
+            self._start_communication(input_to_send)
+        endtime = None if timeout is None else time() + timeout
+        with selectors.DefaultSelector() as selector:
+            if self.inwrite and not self.inwrite.closed:
+                selector.register(self.inwrite, selectors.EVENT_WRITE)
+            for stream in self._outputs:
+                if not stream.closed:
+                    selector.register(stream, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = None
+                if endtime is not None:
+                    remaining = endtime - time()
+                    if remaining <= 0:
+                        raise TimeoutExpired(f'{self._args!r} did not finish within {timeout} seconds')
+                for key, _ in selector.select(remaining):
+                    if key.fileobj is self.inwrite:
+                        self._write_input(selector)
+                    elif not self._outputs[key.fileobj].read_from(key.fileobj):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        self.wait(None if endtime is None else max(endtime - time(), 0))
+        stdout = self._outputs[self.outread].getvalue() if self.outread else None
+        stderr = self._outputs[self.erread].getvalue() if self.erread else None
         return stdout, stderr
 
+    def _read_chunks(self, size):
+        names = {stream: name for stream, name in ((self.outread, 'stdout'), (self.erread, 'stderr')) if stream}
+        with selectors.DefaultSelector() as selector:
+            for stream in names:
+                selector.register(stream, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = key.fileobj.read(size)
+                    if data:
+                        yield names[key.fileobj], data
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+
+    def _drain_chunks(self, size, max_buffered):
+        """Read the pipes in a thread, keeping only the newest max_buffered chunks."""
+        chunks = deque(maxlen=max_buffered)
+        finished = False
+        ready = Condition()
+
+        def drain():
+            nonlocal finished
+            try:
+                for chunk in self._read_chunks(size):
+                    with ready:
+                        chunks.append(chunk)
+                        ready.notify()
+            finally:
+                with ready:
+                    finished = True
+                    ready.notify()
+
+        Thread(target=drain, daemon=True).start()
+        while True:
+            with ready:
+                ready.wait_for(lambda: chunks or finished)
+                if not chunks:
+                    return
+                chunk = chunks.popleft()
+            yield chunk
+
+    def iter_chunks(self, size=_ITER_CHUNK, backpressure=True, max_buffered=_MAX_BUFFERED_CHUNKS):
+        """Yield ('stdout' or 'stderr', data) pairs of at most size bytes as the child writes them.
+
+        With backpressure the pipes are only read when the next chunk is
+        asked for, so a slow consumer makes the child wait on a full pipe.
+        Without it a thread keeps reading so the child never waits, and the
+        oldest chunks are dropped while more than max_buffered are unread.
+        Either way memory stays bounded. The pipes are closed at end of file.
+        """
+        if backpressure:
+            return self._read_chunks(size)
+        return self._drain_chunks(size, max_buffered)
+
+    def iter_lines(self, backpressure=True, max_buffered=_MAX_BUFFERED_CHUNKS, max_line_length=_MAX_LINE_LENGTH):
+        """Yield ('stdout' or 'stderr', line) pairs, lines keep their newline.
+
+        Lines of both streams are tracked separately, so they are never
+        mixed up. Lines longer than max_line_length are yielded in pieces of
+        that size. See iter_chunks for backpressure and max_buffered.
+        """
+        pending = {'stdout': bytearray(), 'stderr': bytearray()}
+        for name, data in self.iter_chunks(_ITER_CHUNK, backpressure, max_buffered):
+            buffer = pending[name]
+            buffer += data
+            start = 0
+            while (end := buffer.find(b'\n', start)) != -1:
+                while end + 1 - start > max_line_length:
+                    yield name, bytes(buffer[start:start + max_line_length])
+                    start += max_line_length
+                yield name, bytes(buffer[start:end + 1])
+                start = end + 1
+            while len(buffer) - start >= max_line_length:
+                yield name, bytes(buffer[start:start + max_line_length])
+                start += max_line_length
+            del buffer[:start]
+        for name, buffer in pending.items():
+            if buffer:
+                yield name, bytes(buffer)
+
+    def _reap(self, options):
+        try:
+            pid, status = os.waitpid(self._child_process_id, options)
+        except ChildProcessError:
+            # Somebody else reaped the child, its status is lost.
+            self.returncode = 0
+            return
+        if pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+    def _exited_within(self, timeout):
+        try:
+            pidfd = os.pidfd_open(self._child_process_id)
+        except ProcessLookupError:
+            return True
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+        finally:
+            os.close(pidfd)
+        return bool(ready)
+
     def poll(self):
-        """Check if child process has terminated. Set and return returncode attribute."""
-        return self.wait()
+        """Check if child process has terminated. Set and return returncode attribute, None while it runs."""
+        if self.returncode is None:
+            self._reap(os.WNOHANG)
+        return self.returncode
 
-    def wait(self):
-        """Wait for child process to terminate; returns self.returncode."""
+    def wait(self, timeout=None):
+        """Wait for child process to terminate; returns self.returncode.
+
+        Only this child is reaped, so other Popen objects keep their exit
+        codes. A negative returncode is the number of the signal that killed
+        the child. Raises TimeoutExpired if it is still running after timeout
+        seconds.
+        """
         if self.returncode is None:
-            pid, code = os.wait()
-            self.returncode = code
-            return code
+            if timeout is not None and not self._exited_within(timeout):
+                raise TimeoutExpired(f'{self._args!r} did not exit within {timeout} seconds')
+            self._reap(0)
         return self.returncode
 
     def send_signal(self, sig):
@@ -130,3 +357,99 @@ class Popen:
 
     def kill(self):
         self.send_signal(signal.SIGKILL)
+
+
+class AsyncPopen(Popen):
+    """Popen for asyncio code, started with `async with AsyncPopen(args, ...) as process`.
+
+    The pipes are served by the running event loop: stdin is an
+    asyncio.StreamWriter, stdout and stderr are asyncio.StreamReader objects.
+    The exit of the child is noticed through its pidfd registered with the
+    loop, so no thread blocks in waitpid per child. asyncio is imported
+    lazily since the subprocess.py next to this module shadows the one it
+    imports.
+    """
+
+    def __init__(self, args, **kwargs):
+        super().__init__(args, **kwargs)
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self._exited = None
+
+    def __enter__(self):
+        raise TypeError('AsyncPopen is started with "async with", not "with"')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.wait()
+
+    @staticmethod
+    async def _connect_reader(loop, pipe):
+        import asyncio
+
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    async def start(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        self._child_process_id = self._start_child()
+        self._exited = loop.create_future()
+        pidfd = os.pidfd_open(self._child_process_id)
+        loop.add_reader(pidfd, self._on_exit, loop, pidfd)
+        if self.inwrite:
+            transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, self.inwrite)
+            self.stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+        if self.outread:
+            self.stdout = await self._connect_reader(loop, self.outread)
+        if self.erread:
+            self.stderr = await self._connect_reader(loop, self.erread)
+
+    def _on_exit(self, loop, pidfd):
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        if self.returncode is None:
+            self._reap(0)
+        if not self._exited.done():
+            self._exited.set_result(self.returncode)
+
+    async def wait(self):
+        """Wait for child process to terminate; returns self.returncode."""
+        import asyncio
+
+        return await asyncio.shield(self._exited)
+
+    async def _feed_stdin(self, input_to_send):
+        with suppress(BrokenPipeError, ConnectionResetError):
+            if input_to_send:
+                self.stdin.write(input_to_send)
+                await self.stdin.drain()
+        self.stdin.close()
+
+    @staticmethod
+    async def _read_all(reader):
+        return None if reader is None else await reader.read()
+
+    async def communicate(self, input_to_send=None):
+        """Send input_to_send to stdin and read stdout and stderr until end of file, all at once.
+
+        Returns (stdout, stderr) after the child exited. Wrap it in
+        asyncio.wait_for for a timeout.
+        """
+        import asyncio
+
+        tasks = [self._read_all(self.stdout), self._read_all(self.stderr)]
+        if self.stdin is not None:
+            tasks.append(self._feed_stdin(input_to_send))
+        stdout, stderr, *_ = await asyncio.gather(*tasks)
+        await self.wait()
+        return stdout, stderr
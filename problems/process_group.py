@@ -0,0 +1,97 @@
+import os
+import selectors
+from threading import Thread, RLock
+from contextlib import suppress
+from future import Future
+from popen import Popen
+from thread_pool import ExecutorShutdown
+
+
+class ProcessGroup:
+    """Runs many children at once and reaps them all from one thread.
+
+    Every child is watched through a pidfd registered with an epoll
+    selector, so a child is reaped as soon as it exits, by its own pid,
+    without a thread or a blocking wait per child. start returns a Future
+    that is resolved with the finished Popen once its child exited.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._processes = {}
+        self._shutdown = False
+        self._shutdown_lock = RLock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._reaper = Thread(target=self._reap, daemon=True)
+        self._reaper.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown(wait=True)
+
+    def __len__(self):
+        """Number of children that did not exit yet."""
+        return len(self._processes)
+
+    def _wakeup(self):
+        with suppress(BlockingIOError):
+            os.write(self._wakeup_write, b'\0')
+
+    def start(self, args, **kwargs):
+        """Start Popen(args, **kwargs) and return a Future for the finished Popen.
+
+        Pipes requested with Popen.PIPE are the caller's to drain, a child
+        blocked on a full pipe never exits.
+        """
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise ExecutorShutdown()
+            process = Popen(args, **kwargs).__enter__()
+            future_result = Future()
+            future_result.set_running()
+            pidfd = os.pidfd_open(process._child_process_id)
+            self._processes[pidfd] = (process, future_result)
+            self._selector.register(pidfd, selectors.EVENT_READ)
+            return future_result
+
+    def send_signal(self, sig):
+        """Send sig to every child that did not exit yet."""
+        with self._shutdown_lock:
+            for process, _ in self._processes.values():
+                with suppress(ProcessLookupError):
+                    process.send_signal(sig)
+
+    def _finish(self, pidfd):
+        with self._shutdown_lock:
+            self._selector.unregister(pidfd)
+            process, future_result = self._processes.pop(pidfd)
+        os.close(pidfd)
+        process.wait()
+        future_result.set_result(process)
+
+    def _reap(self):
+        while True:
+            with self._shutdown_lock:
+                if self._shutdown and not self._processes:
+                    break
+            for key, _ in self._selector.select():
+                if key.fd == self._wakeup_read:
+                    with suppress(BlockingIOError):
+                        os.read(self._wakeup_read, 4096)
+                else:
+                    self._finish(key.fd)
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def shutdown(self, wait=False):
+        """Refuse new children; the reaper stops once the running ones exited."""
+        with self._shutdown_lock:
+            self._shutdown = True
+            self._wakeup()
+        if wait:
+            self._reaper.join()
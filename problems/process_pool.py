@@ -0,0 +1,274 @@
+import os
+import mmap
+import pickle
+import signal
+import socket
+import struct
+import selectors
+from collections import deque
+from contextlib import suppress
+from threading import Thread, RLock
+from future import Future
+from thread_pool import ExecutorShutdown, _check_map_arguments, _ordered_map
+
+
+# Every message is a header followed either by the pickled payload itself
+# or, for payloads above the shared memory threshold, by nothing: the
+# payload is then written to a memfd whose descriptor travels with the
+# header as SCM_RIGHTS ancillary data and is mmap'ed by the receiver.
+_HEADER = struct.Struct('!Q?')
+_INLINE = False
+_SHARED = True
+_SHARED_MEMORY_THRESHOLD = 64 * 1024
+
+
+class WorkerCrashed(Exception):
+    """Throws when the worker process running a task died before returning a result"""
+
+
+class _LoadError(Exception):
+    """Wraps the error raised while unpickling a message that was read completely."""
+
+
+def _loads(data):
+    try:
+        return pickle.loads(data)
+    except Exception as e:
+        raise _LoadError() from e
+
+
+def _receive_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise EOFError()
+        received += count
+    return buffer
+
+
+def _send(sock, obj, threshold=_SHARED_MEMORY_THRESHOLD):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    if len(data) < threshold:
+        sock.sendall(_HEADER.pack(len(data), _INLINE) + data)
+        return
+    fd = os.memfd_create('process-pool', os.MFD_CLOEXEC)
+    try:
+        os.ftruncate(fd, len(data))
+        with mmap.mmap(fd, len(data)) as shared:
+            shared[:] = data
+        socket.send_fds(sock, [_HEADER.pack(len(data), _SHARED)], [fd])
+    finally:
+        os.close(fd)
+
+
+def _receive(sock):
+    header, fds, _, _ = socket.recv_fds(sock, _HEADER.size, 1)
+    if not header:
+        raise EOFError()
+    if len(header) < _HEADER.size:
+        header += _receive_exactly(sock, _HEADER.size - len(header))
+    size, shared = _HEADER.unpack(header)
+    if not shared:
+        return _loads(_receive_exactly(sock, size))
+    fd = fds[0]
+    try:
+        with mmap.mmap(fd, size, prot=mmap.PROT_READ) as shared:
+            return _loads(shared)
+    finally:
+        os.close(fd)
+
+
+def _worker_process(sock, threshold):
+    while True:
+        try:
+            task, args, kwargs = _receive(sock)
+        except EOFError:
+            break
+        except _LoadError as e:
+            message = (False, e.__cause__)
+        else:
+            try:
+                message = (True, task(*args, **kwargs))
+            except Exception as e:
+                message = (False, e)
+        try:
+            _send(sock, message, threshold)
+        except Exception as e:
+            _send(sock, (False, RuntimeError(f'can not send result: {e!r}')), threshold)
+
+
+class _WorkerProcess:
+
+    def __init__(self, threshold, parent_fds):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                parent_sock.close()
+                for fd in parent_fds:
+                    os.close(fd)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                _worker_process(child_sock, threshold)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        child_sock.close()
+        self.pid = pid
+        self.sock = parent_sock
+        self.future = None
+
+    def reap(self):
+        """Wait for the process to exit and return its exit status."""
+        with suppress(ChildProcessError):
+            _, status = os.waitpid(self.pid, 0)
+            return os.waitstatus_to_exitcode(status)
+
+    def close(self):
+        self.sock.close()
+        return self.reap()
+
+
+class ProcessPoolExecutor:
+    """Runs tasks in forked worker processes.
+
+    Tasks, arguments and results must be picklable. Payloads bigger than
+    shared_memory_threshold bytes are passed through shared memory instead
+    of being copied through the socket. A worker that dies while running a
+    task fails that task's future with WorkerCrashed and is replaced.
+    """
+
+    def __init__(self, max_workers=None, shared_memory_threshold=_SHARED_MEMORY_THRESHOLD):
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        if max_workers <= 0:
+            raise ValueError('max_workers must be greater than 0')
+
+        self._max_workers = max_workers
+        self._threshold = shared_memory_threshold
+        self._pending = deque()
+        self._shutdown = False
+        self._shutdown_lock = RLock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+        self._workers = []
+        for _ in range(max_workers):
+            self._start_worker()
+        self._manager = Thread(target=self._manage, daemon=True)
+        self._manager.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown(wait=True)
+
+    def _start_worker(self):
+        """Fork a worker that does not keep the parent's end of any other worker open."""
+        parent_fds = [self._wakeup_read, self._wakeup_write]
+        parent_fds.extend(worker.sock.fileno() for worker in self._workers)
+        worker = _WorkerProcess(self._threshold, parent_fds)
+        self._workers.append(worker)
+        return worker
+
+    def _wakeup(self):
+        with suppress(BlockingIOError):
+            os.write(self._wakeup_write, b'\0')
+
+    def _dispatch(self, worker):
+        while self._pending:
+            future, task, args, kwargs = self._pending.popleft()
+            if not future.set_running():
+                continue
+            try:
+                _send(worker.sock, (task, args, kwargs), self._threshold)
+            except OSError:
+                # The worker is gone, its end of file is handled as a crash.
+                self._pending.appendleft((future, task, args, kwargs))
+                return
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            worker.future = future
+            return
+
+    def _receive_result(self, worker, selector):
+        try:
+            success, value = _receive(worker.sock)
+        except _LoadError as e:
+            # The whole message was read, the worker can take the next task.
+            success, value = False, e.__cause__
+        except (EOFError, OSError):
+            self._replace_worker(worker, selector)
+            return
+        future, worker.future = worker.future, None
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _replace_worker(self, worker, selector):
+        selector.unregister(worker.sock)
+        code = worker.close()
+        self._workers.remove(worker)
+        if worker.future is not None:
+            worker.future.set_exception(WorkerCrashed(f'worker {worker.pid} exited with code {code}'))
+        if not self._shutdown or self._pending:
+            replacement = self._start_worker()
+            selector.register(replacement.sock, selectors.EVENT_READ, replacement)
+
+    def _manage(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_read, selectors.EVENT_READ)
+        for worker in self._workers:
+            selector.register(worker.sock, selectors.EVENT_READ, worker)
+        while True:
+            with self._shutdown_lock:
+                for worker in list(self._workers):
+                    if worker.future is None:
+                        self._dispatch(worker)
+                busy = any(worker.future is not None for worker in self._workers)
+                if self._shutdown and not self._pending and not busy:
+                    break
+            for key, _ in selector.select():
+                if key.data is None:
+                    with suppress(BlockingIOError):
+                        os.read(self._wakeup_read, 4096)
+                else:
+                    self._receive_result(key.data, selector)
+        selector.close()
+        for worker in self._workers:
+            worker.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def map(self, task, *iterables, timeout=None, chunksize=1, buffersize=None):
+        """Lazily map task over iterables, yielding results in input order.
+
+        A chunk of chunksize arguments is sent to a worker as one message.
+        Invalid arguments raise right away, not on the first next().
+        """
+        buffersize = _check_map_arguments(self._max_workers, chunksize, buffersize)
+        return _ordered_map(self.submit, task, iterables, timeout, chunksize, buffersize)
+
+    def submit(self, task, *args, **kwargs):
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise ExecutorShutdown()
+            future_result = Future()
+            self._pending.append((future_result, task, args, kwargs))
+            self._wakeup()
+            return future_result
+
+    def shutdown(self, wait=False):
+        with self._shutdown_lock:
+            self._shutdown = True
+            self._wakeup()
+        if wait:
+            self._manager.join()
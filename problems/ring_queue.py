@@ -0,0 +1,226 @@
+import os
+import mmap
+import fcntl
+import select
+import struct
+import threading
+from queue import Empty, Full
+from time import monotonic as time
+
+
+# Shared header, the records start at _DATA. head is only written by
+# consumers and tail only by producers, both count bytes since creation.
+# A side that goes to sleep raises its waiting flag, the other side clears
+# it and signals the matching eventfd, so nobody pays for a syscall while
+# the queue is neither empty nor full.
+_HEAD = struct.Struct('<Q')
+_TAIL = struct.Struct('<Q')
+_FLAG = struct.Struct('<I')
+_HEAD_OFFSET = 0
+_TAIL_OFFSET = 64
+_GETTER_WAITING_OFFSET = 128
+_PUTTER_WAITING_OFFSET = 132
+_SETTINGS = struct.Struct('<QII')
+_SETTINGS_OFFSET = 192
+_DATA = 256
+_RECORD = struct.Struct('<I')
+
+_MULTI_PRODUCER = 1
+_MULTI_CONSUMER = 2
+
+# Upper bound for one sleep; only matters if a wakeup raced with a waiter
+# raising its flag, which plain loads and stores can not fully exclude.
+_MAX_SLEEP = 0.1
+
+
+class _SideLock:
+    """Excludes threads with a Lock and other processes with a lockf byte range lock."""
+
+    def __init__(self, fd, byte):
+        self._fd = fd
+        self._byte = byte
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._byte)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._byte)
+        self._lock.release()
+
+
+class _NoLock:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+class RingQueue:
+    """Fixed capacity queue of byte records in shared memory, usable across processes.
+
+    The buffer lives in a memfd mapped with MAP_SHARED, so it is shared with
+    forked children as is. Processes started with exec get the numbers from
+    fds() (create the queue with inheritable=True) and call RingQueue.attach.
+    With multi_producer or multi_consumer False the respective side takes no
+    lock at all, which is the single-producer/single-consumer fast path.
+    """
+
+    def __init__(self, capacity=1 << 20, multi_producer=True, multi_consumer=True, inheritable=False):
+        if capacity <= _RECORD.size:
+            raise ValueError(f'capacity must be greater than {_RECORD.size}')
+        flags = 0 if inheritable else os.MFD_CLOEXEC
+        memfd = os.memfd_create('ring-queue', flags)
+        os.ftruncate(memfd, _DATA + capacity)
+        eventfd_flags = os.EFD_NONBLOCK | (0 if inheritable else os.EFD_CLOEXEC)
+        items_fd = os.eventfd(0, eventfd_flags)
+        space_fd = os.eventfd(0, eventfd_flags)
+        settings = (_MULTI_PRODUCER if multi_producer else 0) | (_MULTI_CONSUMER if multi_consumer else 0)
+        buffer = mmap.mmap(memfd, _DATA + capacity)
+        _SETTINGS.pack_into(buffer, _SETTINGS_OFFSET, capacity, settings, 0)
+        self._setup(memfd, items_fd, space_fd, buffer)
+
+    @classmethod
+    def attach(cls, memfd, items_fd, space_fd):
+        """Open a queue created by another process from the descriptors returned by fds()."""
+        queue = cls.__new__(cls)
+        size = os.fstat(memfd).st_size
+        queue._setup(memfd, items_fd, space_fd, mmap.mmap(memfd, size))
+        return queue
+
+    def _setup(self, memfd, items_fd, space_fd, buffer):
+        self._memfd = memfd
+        self._items_fd = items_fd
+        self._space_fd = space_fd
+        self._buffer = buffer
+        self._capacity, settings, _ = _SETTINGS.unpack_from(buffer, _SETTINGS_OFFSET)
+        self._put_lock = _SideLock(memfd, 0) if settings & _MULTI_PRODUCER else _NoLock()
+        self._get_lock = _SideLock(memfd, 1) if settings & _MULTI_CONSUMER else _NoLock()
+
+    def fds(self):
+        """Return (memfd, items_fd, space_fd) to hand to RingQueue.attach in another process."""
+        return self._memfd, self._items_fd, self._space_fd
+
+    def close(self):
+        self._buffer.close()
+        for fd in self.fds():
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _head(self):
+        return _HEAD.unpack_from(self._buffer, _HEAD_OFFSET)[0]
+
+    def _tail(self):
+        return _TAIL.unpack_from(self._buffer, _TAIL_OFFSET)[0]
+
+    def qsize(self):
+        """Return the number of bytes, record headers included, waiting in the queue."""
+        return self._tail() - self._head()
+
+    def empty(self):
+        return self._tail() == self._head()
+
+    def _write(self, position, data):
+        offset = position % self._capacity
+        first = min(len(data), self._capacity - offset)
+        self._buffer[_DATA + offset:_DATA + offset + first] = data[:first]
+        if first < len(data):
+            self._buffer[_DATA:_DATA + len(data) - first] = data[first:]
+
+    def _read(self, position, size):
+        offset = position % self._capacity
+        first = min(size, self._capacity - offset)
+        data = self._buffer[_DATA + offset:_DATA + offset + first]
+        if first < size:
+            data += self._buffer[_DATA:_DATA + size - first]
+        return data
+
+    def _wake(self, flag_offset, fd):
+        if self._buffer[flag_offset]:
+            _FLAG.pack_into(self._buffer, flag_offset, 0)
+            os.eventfd_write(fd, 1)
+
+    def _sleep(self, fd, endtime):
+        """Sleep until the other side signals fd; returns False once endtime passed."""
+        remaining = _MAX_SLEEP
+        if endtime is not None:
+            remaining = min(endtime - time(), _MAX_SLEEP)
+            if remaining <= 0:
+                return False
+        select.select([fd], [], [], remaining)
+        try:
+            os.eventfd_read(fd)
+        except BlockingIOError:
+            pass
+        return True
+
+    def _retry(self, lock, attempt, flag_offset, fd, block, timeout, error):
+        """Call attempt() under lock until it returns something other than None.
+
+        The lock is not held while sleeping, so a waiting process never
+        keeps others of the same side from honouring their own timeouts.
+        """
+        if timeout is not None and timeout < 0:
+            raise ValueError('timeout must be greater than 0')
+        endtime = None if timeout is None else time() + timeout
+        while True:
+            with lock:
+                result = attempt()
+                if result is None and block:
+                    _FLAG.pack_into(self._buffer, flag_offset, 1)
+                    result = attempt()
+            if result is not None:
+                return result
+            if not block or not self._sleep(fd, endtime):
+                raise error
+
+    def _try_put(self, record):
+        tail = _TAIL.unpack_from(self._buffer, _TAIL_OFFSET)[0]
+        if self._capacity - (tail - _HEAD.unpack_from(self._buffer, _HEAD_OFFSET)[0]) < len(record):
+            return None
+        self._write(tail, record)
+        _TAIL.pack_into(self._buffer, _TAIL_OFFSET, tail + len(record))
+        return True
+
+    def _try_get(self):
+        head = _HEAD.unpack_from(self._buffer, _HEAD_OFFSET)[0]
+        if _TAIL.unpack_from(self._buffer, _TAIL_OFFSET)[0] == head:
+            return None
+        offset = head % self._capacity
+        if offset + _RECORD.size <= self._capacity:
+            size = _RECORD.unpack_from(self._buffer, _DATA + offset)[0]
+        else:
+            size = _RECORD.unpack(self._read(head, _RECORD.size))[0]
+        data = self._read(head + _RECORD.size, size)
+        _HEAD.pack_into(self._buffer, _HEAD_OFFSET, head + _RECORD.size + size)
+        return data
+
+    def put(self, data, block=True, timeout=None):
+        """Append one bytes-like record, waiting for space like Queue.put."""
+        record = _RECORD.pack(len(data)) + data
+        if len(record) > self._capacity:
+            raise ValueError(f'record of {len(data)} bytes does not fit into the queue')
+        with self._put_lock:
+            done = self._try_put(record)
+        if done is None:
+            self._retry(self._put_lock, lambda: self._try_put(record), _PUTTER_WAITING_OFFSET,
+                        self._space_fd, block, timeout, Full)
+        self._wake(_GETTER_WAITING_OFFSET, self._items_fd)
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the oldest record as bytes, waiting for one like Queue.get."""
+        with self._get_lock:
+            data = self._try_get()
+        if data is None:
+            data = self._retry(self._get_lock, self._try_get, _GETTER_WAITING_OFFSET,
+                               self._items_fd, block, timeout, Empty)
+        self._wake(_PUTTER_WAITING_OFFSET, self._space_fd)
+        return data
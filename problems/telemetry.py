@@ -0,0 +1,125 @@
+import threading
+from functools import partial
+
+
+class Histogram:
+    """Log2 histogram of durations in nanoseconds.
+
+    Bucket i counts values with bit length i, so recording a value is a
+    bit_length call and a list increment. Percentiles are reported as the
+    upper bound of the bucket they fall into.
+    """
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.buckets):
+            self.buckets[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percent):
+        """Return an upper bound for the given percentile, 0 if nothing was recorded."""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min((1 << index) - 1, self.max)
+        return self.max
+
+    def __repr__(self):
+        return (f'Histogram(count={self.count}, mean={self.mean():.0f}ns, '
+                f'p50={self.percentile(50)}ns, p99={self.percentile(99)}ns, max={self.max}ns)')
+
+
+def _unwrap(task):
+    """Return the function a partial object or a bound method ends up calling."""
+    while isinstance(task, partial):
+        task = task.func
+    return getattr(task, '__func__', task)
+
+
+def _task_name(task):
+    if not hasattr(task, '__qualname__'):
+        task = type(task)
+    module = getattr(task, '__module__', None)
+    return f'{module}.{task.__qualname__}' if module else task.__qualname__
+
+
+class Telemetry:
+    """Per task callable queue-wait time, run time and exception counts.
+
+    Every thread records into its own shard, so recording takes no lock;
+    stats() merges the shards. Tasks are grouped by the function they run:
+    partial objects and bound methods are unwrapped, functions are keyed by
+    their code so lambdas and closures created per task share one entry,
+    and no reference to a task is kept. callback, if given, is called after
+    every task with (task, queue_wait_ns, run_time_ns, exception).
+    """
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def record(self, task, queue_wait, run_time, exception=None):
+        shard = self._shard()
+        function = _unwrap(task)
+        key = getattr(function, '__code__', None) or _task_name(function)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [_task_name(function), 0, Histogram(), Histogram()]
+        if exception is not None:
+            entry[1] += 1
+        entry[2].record(queue_wait)
+        entry[3].record(run_time)
+        if self._callback is not None:
+            try:
+                self._callback(task, queue_wait, run_time, exception)
+            except Exception:
+                print('exception calling telemetry callback')
+
+    def stats(self):
+        """Return {task name: {'exceptions', 'queue_wait', 'run_time'}} merged over all threads."""
+        with self._shards_lock:
+            shards = list(self._shards)
+        result = {}
+        for shard in shards:
+            for name, exceptions, queue_wait, run_time in list(shard.values()):
+                if name not in result:
+                    result[name] = {'exceptions': 0, 'queue_wait': Histogram(), 'run_time': Histogram()}
+                merged = result[name]
+                merged['exceptions'] += exceptions
+                merged['queue_wait'].merge(queue_wait)
+                merged['run_time'].merge(run_time)
+        return result
@@ -1,31 +1,297 @@
 import os
-from queue import SimpleQueue
-from threading import Thread, RLock
-from future import Future
-from time import monotonic as time
+from heapq import heappush, heappop
+from collections import deque
+from itertools import islice, count
+from queue import SimpleQueue, Empty
+from threading import Thread, RLock, Lock, Condition, local, current_thread
+from future import Future, wrap_future
+from time import monotonic as time, monotonic_ns
 
 
-def _worker(queue):
-    while True:
-        work_item = queue.get()
-        if not work_item:
-            break
-        future, task, args, kwargs = work_item
+_worker_context = local()
+
+# Default number of work items map keeps in flight.
+_MAP_BUFFERSIZE = 1024
+
+
+def _run_work_item(work_item):
+    future, task, args, kwargs, deadline, _ = work_item
+    if not future.set_running():
+        return
+    if deadline is not None and deadline < time():
+        future.set_exception(DeadlineExceeded())
+        return
+    try:
+        result = task(*args, **kwargs)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def _run_measured_work_item(work_item, telemetry):
+    future, task, args, kwargs, deadline, enqueued = work_item
+    if not future.set_running():
+        return
+    started = monotonic_ns()
+    if deadline is not None and deadline < time():
+        exception = DeadlineExceeded()
+        future.set_exception(exception)
+    else:
+        exception = None
         try:
             result = task(*args, **kwargs)
         except Exception as e:
+            exception = e
             future.set_exception(e)
         else:
             future.set_result(result)
+    if task is _process_chunk or task is _process_chunk_into:
+        task = args[-2]
+    telemetry.record(task, started - enqueued, monotonic_ns() - started, exception)
+
+
+def _process_chunk(task, chunk):
+    return [task(*args) for args in chunk]
+
+
+def _process_chunk_into(done_queue, task, chunk):
+    try:
+        results = _process_chunk(task, chunk)
+    except Exception as e:
+        done_queue.put((None, e))
+    else:
+        done_queue.put((results, None))
+
+
+def _get_chunks(iterables, chunksize):
+    arguments = zip(*iterables)
+    while chunk := tuple(islice(arguments, chunksize)):
+        yield chunk
+
+
+def _check_map_arguments(max_workers, chunksize, buffersize):
+    if chunksize < 1:
+        raise ValueError('chunksize must be greater than 0')
+    if buffersize is None:
+        # Big enough that the consumer rarely waits on the window,
+        # small enough to keep memory bounded on endless input.
+        buffersize = max(_MAP_BUFFERSIZE, 2 * max_workers)
+    if buffersize < 1:
+        raise ValueError('buffersize must be greater than 0')
+    return buffersize
+
+
+def _ordered_map(submit, task, iterables, timeout, chunksize, buffersize):
+    if timeout is not None:
+        end_time = time() + timeout
+    futures = deque()
+    try:
+        if chunksize == 1:
+            # One work item per argument tuple, no chunk wrapper around the task.
+            arguments = zip(*iterables)
+            futures.extend(submit(task, *args) for args in islice(arguments, buffersize))
+            while futures:
+                if timeout is not None:
+                    result = futures[0].result(end_time - time())
+                else:
+                    result = futures[0].result()
+                futures.popleft()
+                args = next(arguments, None)
+                if args is not None:
+                    futures.append(submit(task, *args))
+                yield result
+            return
+        chunks = _get_chunks(iterables, chunksize)
+        futures.extend(submit(_process_chunk, task, chunk) for chunk in islice(chunks, buffersize))
+        while futures:
+            if timeout is not None:
+                results = futures[0].result(end_time - time())
+            else:
+                results = futures[0].result()
+            futures.popleft()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                futures.append(submit(_process_chunk, task, chunk))
+            yield from results
+    finally:
+        # The consumer stopped early, timed out or a task failed:
+        # do not leave the rest of the window to run for nobody.
+        for future in futures:
+            future.cancel()
+
+
+def _worker(executor, index=None):
+    queue = executor._work_queue
+    telemetry = executor._telemetry
+    if index is not None:
+        _worker_context.queue = queue
+        _worker_context.index = index
+    while True:
+        executor._add_idle(1)
+        while True:
+            try:
+                work_item = queue.get(timeout=executor._keep_alive)
+                break
+            except Empty:
+                if executor._retire_thread():
+                    return
+        executor._add_idle(-1)
+        if not work_item:
+            break
+        if telemetry is None:
+            _run_work_item(work_item)
+        else:
+            _run_measured_work_item(work_item, telemetry)
+
+
+class _WorkStealingQueue:
+    """Set of per-worker deques.
+
+    Owners push and pop at the right end of their own deque (LIFO, cache
+    friendly), thieves take from the left end of someone else's (FIFO, the
+    oldest and usually the biggest piece of work). Single deque operations
+    are atomic, so the only lock is the one idle workers sleep on.
+    """
+
+    def __init__(self, size):
+        self._deques = [deque() for _ in range(size)]
+        self._free_indexes = list(reversed(range(size)))
+        self._next = 0
+        self._closed = False
+        self._sleepers = 0
+        self._idle = Condition(Lock())
+
+    def register(self):
+        return self._free_indexes.pop()
+
+    def unregister(self, index):
+        """Give the deque of a retired worker to the next registered one.
+
+        Items still left in it are taken by the other workers as usual.
+        """
+        self._free_indexes.append(index)
+
+    def qsize(self):
+        return sum(map(len, self._deques))
+
+    def put(self, item):
+        if getattr(_worker_context, 'queue', None) is self:
+            self._deques[_worker_context.index].append(item)
+        else:
+            self._next = (self._next + 1) % len(self._deques)
+            self._deques[self._next].append(item)
+        if self._sleepers:
+            with self._idle:
+                self._idle.notify()
+
+    def _find_work(self, index):
+        try:
+            return self._deques[index].pop()
+        except IndexError:
+            pass
+        count = len(self._deques)
+        for offset in range(1, count):
+            try:
+                return self._deques[(index + offset) % count].popleft()
+            except IndexError:
+                continue
+        return None
+
+    def get(self, timeout=None):
+        """Return the next work item for the calling worker, None once closed and drained.
+
+        Raises Empty if no work showed up within timeout seconds.
+        """
+        index = _worker_context.index
+        while True:
+            work_item = self._find_work(index)
+            if work_item is not None:
+                return work_item
+            with self._idle:
+                self._sleepers += 1
+                try:
+                    work_item = self._find_work(index)
+                    if work_item is not None:
+                        return work_item
+                    if self._closed:
+                        return None
+                    if not self._idle.wait(timeout):
+                        raise Empty
+                finally:
+                    self._sleepers -= 1
+
+    def close(self):
+        with self._idle:
+            self._closed = True
+            self._idle.notify_all()
+
+
+class _PriorityQueue:
+    """Heap ordered by priority, then deadline, then submission order.
+
+    Lower priority values run first, tasks without a deadline go after
+    tasks with one at the same priority.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = count()
+        self._not_empty = Condition(Lock())
+
+    def qsize(self):
+        return len(self._heap)
+
+    def put(self, item, priority=float('inf'), deadline=None):
+        entry = (priority, float('inf') if deadline is None else deadline, next(self._counter), item)
+        with self._not_empty:
+            heappush(self._heap, entry)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        with self._not_empty:
+            if timeout is None:
+                while not self._heap:
+                    self._not_empty.wait()
+            else:
+                end_time = time() + timeout
+                while not self._heap:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            return heappop(self._heap)[-1]
 
 
 class ExecutorShutdown(Exception):
     """Throws when client tries to submit a new task after shutdown"""
 
 
+class DeadlineExceeded(Exception):
+    """Throws when a task's deadline passed before a worker could start it"""
+
+
+class AsyncioExecutor:
+    """Adapter for loop.run_in_executor(AsyncioExecutor(executor), task, *args).
+
+    asyncio expects submit to return a concurrent.futures or an asyncio
+    future, so this one wraps the executor's futures with wrap_future.
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+
+    def submit(self, task, *args, **kwargs):
+        return wrap_future(self._executor.submit(task, *args, **kwargs))
+
+    def shutdown(self, wait=True, **kwargs):
+        self._executor.shutdown(wait)
+
+
 class ThreadPoolExecutor:
 
-    def __init__(self, max_workers=None):
+    def __init__(self, max_workers=None, work_stealing=False, min_workers=0, keep_alive=None,
+                 prioritized=False, telemetry=None):
 
         if max_workers is None:
             max_workers = min(32, (os.cpu_count() or 1) + 4)
@@ -33,8 +299,29 @@ class ThreadPoolExecutor:
         if max_workers <= 0:
             raise ValueError('max_workers must be greater than 0')
 
+        if not 0 <= min_workers <= max_workers:
+            raise ValueError('min_workers must be between 0 and max_workers')
+
+        if keep_alive is not None and keep_alive <= 0:
+            raise ValueError('keep_alive must be greater than 0')
+
+        if work_stealing and prioritized:
+            raise ValueError('work_stealing and prioritized can not be combined')
+
         self._max_workers = max_workers
-        self._work_queue = SimpleQueue()
+        self._min_workers = min_workers
+        self._keep_alive = keep_alive
+        self._idle_workers = 0
+        self._idle_lock = Lock()
+        self._work_stealing = work_stealing
+        self._prioritized = prioritized
+        self._telemetry = telemetry
+        if work_stealing:
+            self._work_queue = _WorkStealingQueue(max_workers)
+        elif prioritized:
+            self._work_queue = _PriorityQueue()
+        else:
+            self._work_queue = SimpleQueue()
         self._threads = []
         self._shutdown = False
         self._shutdown_lock = RLock()
@@ -45,37 +332,144 @@ class ThreadPoolExecutor:
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.shutdown(wait=True)
 
+    def _add_idle(self, delta):
+        with self._idle_lock:
+            self._idle_workers += delta
+
     def _adjust_thread(self):
-        if len(self._threads) < self._max_workers:
-            thread = Thread(target=_worker, args=(self._work_queue,), daemon=True)
-            self._threads.append(thread)
-            thread.start()
+        if len(self._threads) >= self._max_workers:
+            return
+        if self._idle_workers >= self._work_queue.qsize():
+            return
+        index = self._work_queue.register() if self._work_stealing else None
+        thread = Thread(target=_worker, args=(self, index), daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _retire_thread(self):
+        """Called by a worker that stayed idle for keep_alive seconds.
+
+        Returns True if the worker should exit. It keeps running while the
+        pool is at min_workers, during shutdown, or if work is queued that
+        a submitter expects an idle worker to pick up.
+        """
+        with self._shutdown_lock:
+            if self._shutdown or len(self._threads) <= self._min_workers:
+                return False
+            if self._work_queue.qsize():
+                return False
+            self._add_idle(-1)
+            self._threads.remove(current_thread())
+            if self._work_stealing:
+                self._work_queue.unregister(_worker_context.index)
+            return True
 
-    def map(self, task, *iterables, timeout=None):
+    def map(self, task, *iterables, timeout=None, chunksize=1, buffersize=None):
+        """Lazily map task over iterables, yielding results in input order.
+
+        Input is consumed in chunks of chunksize arguments, each chunk is one
+        work item, and at most buffersize chunks are in flight at a time.
+        Invalid arguments raise right away, not on the first next().
+        """
+        buffersize = _check_map_arguments(self._max_workers, chunksize, buffersize)
+        return _ordered_map(self.submit, task, iterables, timeout, chunksize, buffersize)
+
+    def map_unordered(self, task, *iterables, timeout=None, chunksize=1, buffersize=None):
+        """Same as map, but yields results as soon as their chunk completes."""
+        buffersize = _check_map_arguments(self._max_workers, chunksize, buffersize)
+        return self._unordered_map(task, iterables, timeout, chunksize, buffersize)
+
+    def _unordered_map(self, task, iterables, timeout, chunksize, buffersize):
         if timeout is not None:
             end_time = time() + timeout
-        futures = [self.submit(task, *args) for args in zip(*iterables)]
-        for future in futures:
-            if timeout:
-                yield future.result(end_time - time())
-            else:
-                yield future.result()
+        done_queue = SimpleQueue()
+        chunks = _get_chunks(iterables, chunksize)
+        # Futures not finished yet, kept so that they can be cancelled.
+        futures = set()
+        in_flight = 0
+        try:
+            for chunk in islice(chunks, buffersize):
+                self._submit_chunk_into(futures, done_queue, task, chunk)
+                in_flight += 1
+            while in_flight:
+                try:
+                    if timeout is not None:
+                        results, exception = done_queue.get(timeout=max(end_time - time(), 0))
+                    else:
+                        results, exception = done_queue.get()
+                except Empty:
+                    raise TimeoutError()
+                in_flight -= 1
+                if exception is not None:
+                    raise exception
+                for chunk in islice(chunks, 1):
+                    self._submit_chunk_into(futures, done_queue, task, chunk)
+                    in_flight += 1
+                yield from results
+        finally:
+            for future in list(futures):
+                future.cancel()
+
+    def _submit_chunk_into(self, futures, done_queue, task, chunk):
+        future = self.submit(_process_chunk_into, done_queue, task, chunk)
+        futures.add(future)
+        future.add_done_callback(futures.discard)
 
     def submit(self, task, *args, **kwargs):
+        """Schedule task(*args, **kwargs) and return a Future for its result.
+
+        With work_stealing enabled, tasks submitted from inside a running task
+        go to the submitting worker's own deque, external ones are spread
+        round-robin over all workers. Cancelled tasks are skipped without
+        running. See submit_with for priorities and deadlines.
+        """
+        return self._submit(task, args, kwargs, 0, None)
+
+    def submit_with(self, priority=0, deadline=None):
+        """Return a submit function whose tasks get the given scheduling options.
+
+        executor.submit_with(priority=1, deadline=t)(task, *args, **kwargs)
+        keeps all keyword arguments for the task. On a prioritized executor
+        tasks with a lower priority run first. deadline is a time.monotonic()
+        timestamp: a task still queued at that time fails with
+        DeadlineExceeded instead of running.
+        """
+        if priority and not self._prioritized:
+            raise ValueError('priority requires a prioritized executor')
+        return lambda task, *args, **kwargs: self._submit(task, args, kwargs, priority, deadline)
+
+    def _submit(self, task, args, kwargs, priority, deadline):
         with self._shutdown_lock:
             if self._shutdown:
                 raise ExecutorShutdown()
             future_result = Future()
-            work_item = (future_result, task, args, kwargs)
-            self._work_queue.put(work_item)
+            enqueued = None if self._telemetry is None else monotonic_ns()
+            work_item = (future_result, task, args, kwargs, deadline, enqueued)
+            if self._prioritized:
+                self._work_queue.put(work_item, priority, deadline)
+            else:
+                self._work_queue.put(work_item)
             self._adjust_thread()
             return future_result
 
+    def stats(self):
+        """Return per task statistics collected by the telemetry passed to the executor.
+
+        See telemetry.Telemetry.stats, an executor without telemetry returns {}.
+        """
+        if self._telemetry is None:
+            return {}
+        return self._telemetry.stats()
+
     def shutdown(self, wait=False):
         with self._shutdown_lock:
             self._shutdown = True
-        for _ in range(len(self._threads)):
-            self._work_queue.put(None)
+            threads = list(self._threads)
+        if self._work_stealing:
+            self._work_queue.close()
+        else:
+            for _ in range(len(threads)):
+                self._work_queue.put(None)
         if wait:
-            for thread in self._threads:
+            for thread in threads:
                 thread.join()